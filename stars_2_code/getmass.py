@@ -2,7 +2,14 @@
 # Print out the mass of TYCHO model files
 # Greg Vance, 4/23/17
 
-from tycho_model import TYCHO_Model as TM
+from __future__ import print_function  # For Python 3 compatibility
+
+# Use the fast version built on tycho.py if it can be found (it needs
+# Python 3, so Python 2 fails to even compile it)
+try:
+	from tycho_legacy import TYCHO_Model as TM
+except (ImportError, SyntaxError):
+	from tycho_model import TYCHO_Model as TM
 import sys
 
 msun = 1.98855e33 # grams
@@ -10,6 +17,6 @@ msun = 1.98855e33 # grams
 for mod in sys.argv[1:]:
 	model = TM(mod)
 	mass = sum(model.physics["zone mass"])
-	print mod, "\t", mass/msun, "Msun"
+	print(mod, "\t", mass/msun, "Msun")
 	del model
 
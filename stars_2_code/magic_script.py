@@ -6,7 +6,12 @@
 
 # Greg Vance, 4/19/17
 
-from tycho_model import TYCHO_Model as TM  # Uses tycho_model.py
+# Use the fast version built on tycho.py if it can be found (it needs
+# Python 3, so Python 2 fails to even compile it)
+try:
+	from tycho_legacy import TYCHO_Model as TM
+except (ImportError, SyntaxError):
+	from tycho_model import TYCHO_Model as TM  # Uses tycho_model.py
 import glob  # Bash-like wildcard (*) functionality in python
 
 # This string should match all of the model files you want to read in
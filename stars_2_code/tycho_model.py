@@ -7,6 +7,8 @@
 
 # Greg Vance, 4/20/17
 
+from __future__ import print_function  # For Python 3 compatibility
+
 class TYCHO_Model:
 	"""Simple class for reading and exploring TYCHO model files."""
 	
@@ -153,16 +155,16 @@ def whyyy_float(string):
 def main():
 	"""Test function to make sure the class works properly."""
 	tycho = TYCHO_Model("Ea00650")
-	print "File:", tycho.filename
-	print tycho.first_line
-	print "Prefix:", tycho.prefix
-	print "Mass:", tycho.mass
-	print "NNet:", tycho.network_size
-	print "Z:", tycho.metallicity
-	print "kk:", tycho.header["kk"]
-	print "xm(kk):", tycho.header["xm(kk)"]
-	print "opatab:", tycho.header["opacity tables used"]
-	print "core H:", tycho.composition["p"][0]
+	print("File:", tycho.filename)
+	print(tycho.first_line)
+	print("Prefix:", tycho.prefix)
+	print("Mass:", tycho.mass)
+	print("NNet:", tycho.network_size)
+	print("Z:", tycho.metallicity)
+	print("kk:", tycho.header["kk"])
+	print("xm(kk):", tycho.header["xm(kk)"])
+	print("opatab:", tycho.header["opacity tables used"])
+	print("core H:", tycho.composition["p"][0])
 
 if __name__ == "__main__":
 	main()
@@ -11,7 +11,7 @@
 # TODO:
 # Get dimensions for: rotation, angular momentum, convection speed, luminosity
 # Is zone mass the just the mass coordinate value? Or something else?
-# Figure out how to calculate internal energy
+# Account for degeneracy when calculating internal energy
 
 
 # IMPORT STATEMENTS
@@ -19,21 +19,38 @@
 
 from __future__ import division, print_function  # For Python 2 compatibility
 
+import os
 import re
+import bz2
+import gzip
+import json
+import lzma
+import mmap
+import time
+import shutil
+import logging
+import hashlib
+import tempfile
 import numpy as np
 from collections import OrderedDict
-import astropy.units as u
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+# Everything needed to read just the header lives in its own module without
+# Numpy, but it's all available from here as well
+from tycho_header import STR_PAT, COMPRESSION_MAGIC, recover_float, convert, \
+	open_stream, source_name, close_stream, read_head, parse_first, \
+	parse_header, read_header
 
 
 # GLOBAL CONSTANTS
 ##################
 
-# Regular expression patterns for matching ints, floats, isotopes, etc.
+# Regular expression patterns for matching ints, floats and isotopes, on top
+# of STR_PAT for strings
 INT_PAT = r"[-+]?[0-9]+"  # Integer with possible sign
 FLT_PAT = r"[-+]?(?:[0-9]+\.[0-9]*|\.[0-9]+)" \
 	+ r"(?:[eE][-+]?[0-9]+|[-+][0-9]+)?"  # Allow for missing 'E'
 ISO_PAT = r"[a-zY]{1,2}[0-9]{0,3}"  # Name of isotope, e.g., d, he3, ti44, Ye
-STR_PAT = r"\S+(?: \S+)*"  # String with optional single spaces
 
 # Regular expression patterns for matching blocks of data in a Tycho model file
 FIRST_LINE = r"^TYCHO( +\S+)+ *$\n?"
@@ -55,68 +72,840 @@ TYCHO_PATTERN = "|".join([
 	r"(?P<BLANK>" + BLANK_LINES + r")",
 ])
 
-# Units table for trying to keep track of how things are measured in Tycho.
-# Patrick says everything is in CGS, but I'm not 100% sure about the dimensions
-# of every quantity that might occur in here.
-UNITS_TABLE = {
-	"radius": u.centimeter,
-	"velocity" : u.centimeter / u.second,
-	"rotation" : None,  # Probably rad/s, not sure
-	"angular momentum": None,  # Not sure, ask Patrick
-	"temperature": u.Kelvin,
-	"specific volume": u.centimeter**3 / u.gram,  # == 1/rho
-	"pressure": u.gram / (u.centimeter * u.second**2),  # force per area
-	"zone mass": None,  # Almost certainly grams, not 100% sure
-	"convection speed": None,  # Probably cm/s, not sure
-	"luminosity": None,  # Probably erg/s, not sure
-	"nz": u.Dalton,  # Not really necessary...
- 	"nn": u.Dalton,  # Not really necessary...
-	"initial composition": u.dimensionless_unscaled,  # Mass fractions
+# Single-line versions of the same patterns, in the same order of precedence,
+# for classifying a Tycho model file one line at a time instead
+LINE_PATTERNS = OrderedDict([
+	("FIRST", r"TYCHO( +\S+)+ *"),
+	("ISOTOPE", r" *" + ISO_PAT + r"( *" + ISO_PAT + r")* *"),
+	("HEADER", r" *" + STR_PAT + r" {2,}" + STR_PAT + r" *"),
+	("INT", r" *" + INT_PAT + r"( +" + INT_PAT + r")* *"),
+	("FLOAT", r" *" + FLT_PAT + r"( +" + FLT_PAT + r")* *"),
+	("LABEL", r" *" + STR_PAT + r" *"),
+	("BLANK", r" *"),
+])
+
+# Classifications that need a run of two or more lines to make a whole block
+MULTILINE_BLOCKS = ["ISOTOPE", "HEADER", "INT", "FLOAT", "BLANK"]
+
+# Maximum number of lines to match in one go when extending a block, which
+# keeps the memory used by the re module for backtracking small and bounded
+RUN_LENGTH = 256
+
+# Amount of data to read at a time when streaming a model file
+CHUNK_SIZE = 1024**2
+
+# How to open a file for writing, based on the extension of its name
+COMPRESSION_SUFFIXES = {
+	".gz": gzip.open,
+	".bz2": bz2.open,
+	".xz": lzma.open,
 }
 
+# Formats for writing values back out to a model file, with enough digits for
+# floats to come back exactly, and values per line for each kind of block
+# Values are kept one space apart so that no line can pass for a header line
+FLOAT_FORMAT = " %.16E"
+INT_FORMAT = " %d"
+ISOTOPE_FORMAT = "%5s"
+FLOATS_PER_LINE = 5
+INTS_PER_LINE = 20
+ISOTOPES_PER_LINE = 10
+
+# Compiled versions of the line patterns for matching raw bytes, along with
+# patterns for matching a bounded run of lines of each multiline kind
+LINE_REGEXES = [(kind, re.compile(pattern.encode("ascii")))
+	for kind, pattern in LINE_PATTERNS.items()]
+LINE_REGEX = dict(LINE_REGEXES)
+RUN_REGEXES = dict((kind, re.compile(("(?:^" + LINE_PATTERNS[kind]
+	+ r"$\n?){1," + str(RUN_LENGTH) + "}").encode("ascii"), re.MULTILINE))
+	for kind in MULTILINE_BLOCKS)
+
+# Classifications of the blocks at the start of a model file, before the data
+HEAD_BLOCKS = ["FIRST", "HEADER", "BLANK"]
+
+# Logger for reporting parse statistics, which get collected for every model
+# read while it's enabled for debug messages
+logger = logging.getLogger("tycho")
+
+# Radiation constant a in erg/(cm^3 K^4), for the radiation energy density aT^4
+RADIATION_CONSTANT = 7.5657e-15
+
+# Default location and size limit (in bytes) for caches of parsed model files
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tychopy")
+CACHE_SIZE_LIMIT = 4 * 1024**3
+
+# Fraction of the size limit to shrink a cache down to once it goes over, so
+# that it isn't over again (and scanned all over again) with the next model
+CACHE_EVICT_TARGET = 0.9
+
+# Number of bytes at the end of a model file to look through for its last line
+TAIL_SIZE = 256
+
 
 # UTILITY FUNCTIONS
 ###################
 
-def recover_float(string):
-	"""Parse and return a floating point number from a string that Fortran may
-	or may not have mangled.
+def scan_blocks(contents, start=0, stop=None, final=True):
+	"""Classify all of the blocks of data in the contents of a Tycho model
+	file (as bytes or a memory map) between the given positions, and yield a
+	tuple of (classification, start, stop) for each one. The results are the
+	same as matching TYCHO_PATTERN, including skipping over any lines that
+	fit no classification at all (the only exception being a lone blank line
+	at the very end, which gets skipped too), but the file is processed one
+	line at a time so that the time taken only grows linearly with its size.
+	If final is False, then the contents are only the first part of what's
+	still to come, and scanning stops as soon as more data could change how
+	a block gets classified. It can pick up again from the stop of the last
+	block yielded once more data is available.
 	"""
 	
-	# Remove whitespace and try to parse the float the easy way
-	string = string.strip()
-	try:
-		value = float(string)
-	
-	# If that strategy fails, then check that the 'E' is missing and fix it
-	except ValueError:
-		match = re.match(r"^([-+]?[0-9]+\.[0-9]+)([-+][0-9]+)$", string)
-		if match:
-			value = float(match.group(1) + "E" + match.group(2))
+	pos = start
+	end = len(contents) if stop is None else stop
+	while pos < end:
+		
+		# Find the end of the current line and the start of the next one
+		eol = contents.find(b"\n", pos, end)
+		eol = end if eol < 0 else eol
+		after = min(eol + 1, end)
+		second = None  # Only look for the end of the next line if needed
+		
+		# Classifying a line can take the whole next line as well, so wait for
+		# more data if that hasn't all arrived yet
+		if not final:
+			second = contents.find(b"\n", after, end)
+			if eol == end or second < 0:
+				return
+		
+		# Try each classification in order, just like the alternatives in
+		# TYCHO_PATTERN, and take the first one that fits
+		for kind, regex in LINE_REGEXES:
+			if not regex.fullmatch(contents, pos, eol):
+				continue
+			
+			# A single line is enough for everything but multiline blocks
+			if kind not in RUN_REGEXES:
+				yield kind, pos, after
+				pos = after
+				break
+			
+			# Multiline blocks need the next line to fit as well, except that a
+			# lone empty line is still a block of its own (unless it's last),
+			# just like in TYCHO_PATTERN, which can match it twice over
+			if after >= end:
+				continue
+			if second is None:
+				second = contents.find(b"\n", after, end)
+				second = end if second < 0 else second
+			if not regex.fullmatch(contents, after, second):
+				if kind == "BLANK" and eol == pos:
+					yield kind, pos, after
+					pos = after
+					break
+				continue
+			
+			# Then the block keeps going for as long as the lines all fit
+			block_end = min(second + 1, end)
+			while block_end < end:
+				match = RUN_REGEXES[kind].match(contents, block_end, end)
+				if match is None or match.end() == block_end:
+					break
+				block_end = match.end()
+			
+			# The block could still go on if the line after isn't all there
+			if not final and contents.find(b"\n", block_end, end) < 0:
+				return
+			
+			yield kind, pos, block_end
+			pos = block_end
+			break
+		
+		# Skip any line that doesn't fit anything
 		else:
-			msg = "recover_float failed to parse string: " + repr(string)
-			raise ValueError(msg)
-	
-	return value
+			pos = after
 
-def convert(string):
-	"""Convert the given string to an int or float if appropriate."""
+def recover_floats(string, stats=None):
+	"""Parse a whole block of whitespace-separated floats into a Numpy array
+	in one pass. Values where Fortran has left out the 'E' get the same repair
+	as in recover_float, and the results are identical to calling it on every
+	value one at a time. If stats is a ParseStats object, then the number of
+	floats and repairs (and any fallback to recover_float) get counted in it.
+	"""
+	
+	# Look at the block as a Numpy array of raw characters
+	if isinstance(string, bytes):
+		data = string
+	else:
+		data = string.encode("ascii", "replace")
+	chars = np.frombuffer(data, dtype=np.uint8)
+	
+	# Classify the characters and find where each value starts
+	space = chars <= ord(" ")
+	digit = (chars >= ord("0")) & (chars <= ord("9"))
+	sign = (chars == ord("-")) | (chars == ord("+"))
+	starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
 	
-	# Try converting to an int first, then to a float, then just give up
+	# Any digit followed directly by a sign is a value with its 'E' missing
+	# Only insert the 'E's if every one of those values has a digit before the
+	# decimal point, since otherwise recover_float would refuse to fix it
+	missing = np.flatnonzero(digit[:-1] & sign[1:]) + 1
+	if len(missing) > 0:
+		first = starts[np.searchsorted(starts, missing, side="right") - 1]
+		if np.all(digit[first + sign[first]]):
+			data = np.insert(chars, missing, ord("E")).tobytes()
+	
+	# Let Numpy convert everything in bulk without any Python loops
 	try:
-		value = int(string)
+		values = np.fromstring(data, sep=" ")
 	except ValueError:
+		values = None
+	
+	# Numpy either complains or stops short at anything it can't parse, so redo
+	# the block the slow way if needed in order to get the proper error message
+	if values is None or len(values) != len(starts):
+		if isinstance(string, bytes):
+			string = string.decode("ascii", "replace")
+		values = np.array([recover_float(s) for s in string.split()])
+		if stats is not None:
+			stats.fallback_blocks += 1
+	
+	if stats is not None:
+		stats.floats += len(values)
+		stats.repaired_floats += len(missing)
+	
+	return values
+
+def _convert_block(string, dtype, stats=False):
+	"""Convert one block of floats with recover_floats on a worker, returning
+	the array with the given dtype, along with a new ParseStats with its
+	counts in it if stats is True (or None otherwise).
+	"""
+	
+	block_stats = ParseStats() if stats else None
+	values = recover_floats(string, block_stats).astype(dtype, copy=False)
+	
+	return values, block_stats
+
+def field_filter(fields=None, exclude=None):
+	"""Return a function that says whether or not a key should be read from a
+	model file, given the list of fields wanted (or None for all of them) and
+	a list of fields to leave out (or None to keep all of them).
+	"""
+	
+	fields = None if fields is None else set(fields)
+	exclude = set() if exclude is None else set(exclude)
+	
+	def wanted(label):
+		return (fields is None or label in fields) and label not in exclude
+	
+	return wanted
+
+def stream_blocks(stream, chunk_size=CHUNK_SIZE, stats=None):
+	"""Classify all of the blocks of data in a Tycho model file that is read
+	from a stream one chunk at a time, and yield a tuple of (classification,
+	contents, start, stop) for each one, where contents[start:stop] is the
+	text of the block. Only the data since the end of the last whole block is
+	kept around, so the contents are only valid until the next block. If
+	stats is a ParseStats object, then the bytes read get counted in it.
+	"""
+	
+	buffer = b""
+	carry = b""
+	while True:
+		
+		# Read the next chunk, which is empty at the end of the stream
+		chunk = stream.read(chunk_size)
+		if not isinstance(chunk, bytes):
+			chunk = chunk.encode()
+		final = not chunk
+		if stats is not None:
+			stats.bytes_scanned += len(chunk)
+		
+		# Patterns expect Unix line endings, so fix those, but hold on to any
+		# carriage return at the very end since a newline might come next
+		chunk = carry + chunk
+		carry = b""
+		if not final and chunk.endswith(b"\r"):
+			chunk, carry = chunk[:-1], chunk[-1:]
+		if chunk.find(b"\r") >= 0:
+			chunk = re.sub(b"\r\n?", b"\n", chunk)
+		
+		# Classify as many whole blocks as possible, then keep the rest
+		contents = buffer + chunk
+		resume = 0
+		for classified, start, stop in scan_blocks(contents, final=final):
+			yield classified, contents, start, stop
+			resume = stop
+		if final:
+			return
+		buffer = contents[resume:]
+
+def map_file(filename):
+	"""Return the contents of the given file as a read-only memory map that
+	can be searched and sliced just like bytes, without reading the whole
+	file into memory. Falls back to plain bytes when the file can't be mapped.
+	"""
+	
+	with open(filename, "rb") as openfile:
+		
+		# Map the whole file, unless it's empty or a pipe that can't be mapped
 		try:
-			value = recover_float(string)  # Never trust floats from Fortran
-		except ValueError:
-			value = str(string)  # Eliminate any weird subclasses of str
+			contents = mmap.mmap(openfile.fileno(), 0, access=mmap.ACCESS_READ)
+		except (ValueError, OSError):
+			contents = openfile.read()
 	
-	return value
+	# The file is read front to back, so let the OS know if we can
+	if isinstance(contents, mmap.mmap) and hasattr(contents, "madvise"):
+		contents.madvise(mmap.MADV_SEQUENTIAL)
+	
+	# Patterns expect Unix line endings, which text mode used to take care of
+	if contents.find(b"\r") >= 0:
+		contents = re.sub(b"\r\n?", b"\n", contents[:])
+	
+	return contents
+
+def unmap_file(contents):
+	"""Close a memory map returned by map_file, if it was one."""
+	
+	# If something (like the traceback from a parsing error) still holds on to
+	# part of the map, it will just have to be closed by garbage collection
+	if isinstance(contents, mmap.mmap):
+		try:
+			contents.close()
+		except BufferError:
+			pass
+
+def format_block(fmt, values, per_line):
+	"""Format a sequence of values as lines of text with per_line values on
+	each, all in one go by building a single format string for the whole block
+	instead of formatting one value at a time. Blocks of data in a model file
+	need at least two lines, so values are spread out over two lines if there
+	aren't enough of them to fill more.
+	"""
+	
+	# Make sure that there will be two lines
+	if len(values) < 2:
+		msg = "can't write a block with fewer than two values"
+		raise ValueError(msg)
+	per_line = min(per_line, (len(values) + 1) // 2)
+	
+	# One format string, repeated for every whole line and then the rest
+	lines, extra = divmod(len(values), per_line)
+	template = (fmt * per_line + "\n") * lines
+	if extra:
+		template += fmt * extra + "\n"
+	
+	return template % tuple(values)
+
+
+# PARSE STATISTICS
+##################
+
+class ParseStats(object):
+	"""Counts and timings collected while reading a Tycho model file, to help
+	find out where the time goes. For each block classification, counts holds
+	the number of blocks, nbytes their total size and times the seconds spent
+	processing them, while scan_time is the time spent reading and classifying
+	the file, and convert_time is the part of the processing spent turning
+	floats into arrays (including any done later on by lazy mode). Stats for
+	any number of models can be added together (or passed to sum) to get
+	totals for a batch.
+	"""
+	
+	def __init__(self):
+		self.models = 0
+		self.cache_hits = 0
+		self.bytes_scanned = 0
+		self.counts = OrderedDict((kind, 0) for kind in LINE_PATTERNS)
+		self.nbytes = OrderedDict((kind, 0) for kind in LINE_PATTERNS)
+		self.times = OrderedDict((kind, 0.0) for kind in LINE_PATTERNS)
+		self.scan_time = 0.0
+		self.convert_time = 0.0
+		self.total_time = 0.0
+		self.floats = 0
+		self.repaired_floats = 0
+		self.fallback_blocks = 0
+	
+	def __repr__(self):
+		return "ParseStats(models=%d, bytes_scanned=%d, total_time=%.6f)" \
+			% (self.models, self.bytes_scanned, self.total_time)
+	
+	def __add__(self, other):
+		total = ParseStats()
+		for stats in [self, other]:
+			for name, value in stats.as_dict().items():
+				if isinstance(value, dict):
+					for kind, number in value.items():
+						getattr(total, name)[kind] += number
+				else:
+					setattr(total, name, getattr(total, name) + value)
+		return total
+	
+	def __radd__(self, other):
+		
+		# Let sum() start from its usual 0
+		if other == 0:
+			return self + ParseStats()
+		return NotImplemented
+	
+	def as_dict(self):
+		"""Return all of the stats as a plain (nested) dict."""
+		
+		return OrderedDict((name, dict(value) if isinstance(value, dict)
+			else value) for name, value in vars(self).items())
+	
+	def summary(self):
+		"""Return a table of the stats as a multiline string."""
+		
+		lines = ["%-8s %8s %12s %10s" % ("block", "count", "bytes", "seconds")]
+		for kind in self.counts:
+			lines.append("%-8s %8d %12d %10.6f" % (kind, self.counts[kind],
+				self.nbytes[kind], self.times[kind]))
+		lines.append("scanned %d bytes in %.6f s, converted %d floats "
+			"(%d repaired, %d fallback blocks) in %.6f s, %.6f s total" % (
+			self.bytes_scanned, self.scan_time, self.floats,
+			self.repaired_floats, self.fallback_blocks, self.convert_time,
+			self.total_time))
+		return "\n".join(lines)
+
+
+# UNITS
+#######
+
+# Importing astropy.units takes the better part of a second, so the units table
+# only gets built (and astropy imported) the first time that it's needed
+_units_table = None
+
+def units_table():
+	"""Return the units table, which maps keys of a TychoModel to their
+	astropy units, building it on the first call.
+	"""
+	
+	global _units_table
+	if _units_table is None:
+		import astropy.units as u
+		
+		# Units table for trying to keep track of how things are measured in
+		# Tycho. Patrick says everything is in CGS, but I'm not 100% sure about
+		# the dimensions of every quantity that might occur in here.
+		_units_table = {
+			"radius": u.centimeter,
+			"velocity" : u.centimeter / u.second,
+			"rotation" : None,  # Probably rad/s, not sure
+			"angular momentum": None,  # Not sure, ask Patrick
+			"temperature": u.Kelvin,
+			"specific volume": u.centimeter**3 / u.gram,  # == 1/rho
+			"pressure": u.gram / (u.centimeter * u.second**2),  # force per area
+			"zone mass": None,  # Almost certainly grams, not 100% sure
+			"convection speed": None,  # Probably cm/s, not sure
+			"luminosity": None,  # Probably erg/s, not sure
+			"nz": u.Dalton,  # Not really necessary...
+			"nn": u.Dalton,  # Not really necessary...
+			"initial composition": u.dimensionless_unscaled,  # Mass fractions
+		}
+	
+	return _units_table
+
+def __getattr__(name):
+	"""Build UNITS_TABLE only when someone actually looks it up."""
+	
+	if name == "UNITS_TABLE":
+		return units_table()
+	raise AttributeError("module " + repr(__name__) + " has no attribute "
+		+ repr(name))
+
+
+# DERIVED QUANTITIES
+####################
+
+# Each of these takes a TychoModel and returns a Numpy array with one value per
+# zone, looking up whatever it needs through model.derived so that anything
+# derived along the way gets memoized too
+
+def derive_density(model):
+	"""Density, the multiplicative inverse of specific volume."""
+	
+	return 1.0 / model.derived("specific volume")
+
+def derive_enclosed_mass(model):
+	"""Mass enclosed by the outer edge of each zone, summed from the center."""
+	
+	return np.cumsum(model.derived("zone mass"))
+
+def derive_exterior_mass(model):
+	"""Mass lying outside of the outer edge of each zone."""
+	
+	enclosed = model.derived("enclosed mass")
+	return enclosed[-1] - enclosed
+
+def derive_column_depth(model):
+	"""Column depth, the integral of density over radius from each zone out to
+	the surface, taking each zone to run from the radius of the one before.
+	"""
+	
+	radius = model.derived("radius")
+	thickness = np.diff(radius, prepend=0.0)
+	column = model.derived("density") * thickness
+	return np.cumsum(column[::-1])[::-1]
+
+def derive_mean_molecular_weight(model):
+	"""Mean molecular weight, assuming everything is fully ionized."""
+	
+	fractions, nz, inverse = model._mass_fractions()
+	return 1.0 / (((1.0 + nz) * inverse) @ fractions)
+
+def derive_abar(model):
+	"""Average mass number of the nuclei, weighted by number."""
+	
+	fractions, nz, inverse = model._mass_fractions()
+	return 1.0 / (inverse @ fractions)
+
+def derive_zbar(model):
+	"""Average proton number of the nuclei, weighted by number."""
+	
+	fractions, nz, inverse = model._mass_fractions()
+	return model.derived("abar") * ((nz * inverse) @ fractions)
+
+def derive_ye(model):
+	"""Electron fraction Ye, assuming everything is fully ionized."""
+	
+	fractions, nz, inverse = model._mass_fractions()
+	return (nz * inverse) @ fractions
+
+def derive_internal_energy(model):
+	"""Specific internal energy of an ideal gas plus radiation, taking the
+	radiation pressure out of the total and leaving the rest to the gas. This
+	ignores degeneracy, so it's only a rough guide in the densest zones.
+	"""
+	
+	density = model.derived("density")
+	radiation = RADIATION_CONSTANT * model.derived("temperature")**4
+	gas_pressure = model.derived("pressure") - radiation / 3.0
+	return (1.5 * gas_pressure + radiation) / density
+
+# Table of derived quantities, giving what each depends on and how to compute
+# it. Dependencies can be keys from the model file, other derived quantities,
+# or "composition" for the mass fractions of every isotope along with the nz
+# and nn arrays.
+DERIVED_QUANTITIES = OrderedDict([
+	("density", (["specific volume"], derive_density)),
+	("enclosed mass", (["zone mass"], derive_enclosed_mass)),
+	("exterior mass", (["enclosed mass"], derive_exterior_mass)),
+	("column depth", (["radius", "density"], derive_column_depth)),
+	("mean molecular weight", (["composition"],
+		derive_mean_molecular_weight)),
+	("abar", (["composition"], derive_abar)),
+	("zbar", (["composition", "abar"], derive_zbar)),
+	("Ye", (["composition"], derive_ye)),
+	("internal energy", (["density", "temperature", "pressure"],
+		derive_internal_energy)),
+])
+
+def derived_dependencies(name):
+	"""Return the set of everything that a derived quantity depends on, both
+	directly and through other derived quantities.
+	"""
+	
+	found = set()
+	pending = [name]
+	while pending:
+		depends = DERIVED_QUANTITIES.get(pending.pop(), ([], None))[0]
+		for depend in depends:
+			if depend not in found:
+				found.add(depend)
+				pending.append(depend)
+	
+	return found
+
+
+# LAYOUT TEMPLATES
+##################
+
+class ModelLayout(object):
+	"""The block structure of one Tycho model file, for use as a template when
+	reading the other model files from the same run. Siblings have the same
+	labels in the same order, the same isotopes, and the same number of
+	values on each line, so everything but the header and the number of zones
+	stays put. Given a template, a model file only needs its header scanned,
+	and then the position of every block can be worked out from the size of
+	the first block of zones, with just the first and last lines of each
+	block (and every label) checked to make sure that they really are what
+	they should be. Anything that doesn't match gets read the usual way.
+	"""
+	
+	def __init__(self, filename):
+		"""Scan the given plain model file to use as a template."""
+		
+		self.filename = filename
+		contents = map_file(filename)
+		try:
+			spans = list(scan_blocks(contents))
+			
+			# Everything after the header and before the blanks at the end is
+			# the body, which is what the template covers
+			first = 0
+			while first < len(spans) and spans[first][0] in HEAD_BLOCKS:
+				first += 1
+			last = len(spans)
+			while last > first and spans[last - 1][0] == "BLANK":
+				last -= 1
+			if first == last:
+				msg = "model file " + repr(filename) + " has no data blocks"
+				raise ValueError(msg)
+			body = spans[first:last]
+			
+			# The first block of floats with a label sets the size of a block
+			# of zones, and any other block of floats that size has zones too
+			zone_size = None
+			for (kind, start, stop), (before, _, _) in zip(body[1:], body):
+				if kind == "FLOAT" and before == "LABEL":
+					zone_size = stop - start
+					break
+			
+			# Record each block of the body, along with any gap after it
+			self.blocks = []
+			for i, (kind, start, stop) in enumerate(body):
+				gap = body[i + 1][1] - stop if i + 1 < len(body) else 0
+				text = contents[start:stop] if kind == "LABEL" else None
+				zones = kind == "FLOAT" and stop - start == zone_size
+				self.blocks.append((kind, stop - start, gap, text, zones))
+		finally:
+			unmap_file(contents)
+	
+	def __repr__(self):
+		return "ModelLayout(" + repr(self.filename) + ")"
+	
+	def match(self, contents):
+		"""Return a list of (classification, start, stop) for every block in
+		the contents of a model file, just like scan_blocks would, using the
+		template for the body, or None if the file doesn't fit the template.
+		"""
+		
+		# The header is different every time, so scan it the usual way, up to
+		# the start of the first block of the body
+		spans = []
+		pos = len(contents)
+		for kind, start, stop in scan_blocks(contents):
+			if kind not in HEAD_BLOCKS:
+				pos = start
+				break
+			spans.append((kind, start, stop))
+		
+		# Then lay out the body using the template
+		zone_size = None
+		for i, (kind, size, gap, text, zones) in enumerate(self.blocks):
+			
+			# Labels have to match exactly
+			if kind == "LABEL":
+				if contents[pos:pos + size] != text:
+					return None
+			
+			# The first block of zones gets measured by finding the label
+			# that comes after it
+			elif zones:
+				if zone_size is None:
+					after = self.blocks[i + 1] if i + 1 < len(self.blocks) \
+						else None
+					if after is None or after[0] != "LABEL":
+						return None
+					found = contents.find(b"\n" + after[3], pos)
+					if found < 0:
+						return None
+					zone_size = found + 1 - gap - pos
+				size = zone_size
+			
+			# Check that the block starts and ends with whole lines of its kind
+			stop = pos + size
+			if stop > len(contents) or contents[stop - 1:stop] != b"\n" \
+					or contents[stop:stop + gap].strip() != b"":
+				return None
+			if kind != "LABEL":
+				regex = LINE_REGEX[kind]
+				eol = contents.find(b"\n", pos, stop)
+				if not regex.fullmatch(contents, pos, eol):
+					return None
+				bol = contents.rfind(b"\n", pos, stop - 1) + 1
+				if not regex.fullmatch(contents, bol, stop - 1):
+					return None
+			
+			spans.append((kind, pos, stop))
+			pos = stop + gap
+		
+		# Nothing but blank lines can come after the body
+		for kind, start, stop in scan_blocks(contents, pos):
+			if kind != "BLANK":
+				return None
+			spans.append((kind, start, stop))
+		if contents[pos:].strip() != b"":
+			return None
+		
+		return spans
+
+
+# SPARSE COMPOSITION
+####################
+
+class SparseComposition(object):
+	"""Compressed storage for a composition matrix (one row per isotope, one
+	column per zone) where most of the mass fractions are tiny. Only values
+	above the floor are kept, in the usual compressed sparse row layout of
+	data, indices and indptr arrays, and everything else counts as zero.
+	Rows can be set one at a time while a model file is being read, and the
+	whole matrix can be turned back into a dense Numpy array on demand. Matrix
+	products with weights on the left (like weights @ matrix, for any 1D or
+	2D array of weights) are done directly on the stored values.
+	"""
+	
+	# Make Numpy leave weights @ matrix to __rmatmul__ instead of trying to
+	# turn this into an array first
+	__array_ufunc__ = None
+	
+	def __init__(self, shape, floor=0.0, dtype=np.float64):
+		"""Set up an all-zero matrix of the given shape, which only keeps
+		values whose magnitude is more than the floor.
+		"""
+		
+		self.shape = tuple(shape)
+		self.floor = floor
+		self.dtype = np.dtype(dtype)
+		
+		# Each row as a pair of (indices, data) arrays, plus the compressed
+		# version of all of them together, once it's been needed
+		empty = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=self.dtype))
+		self._rows = [empty] * self.shape[0]
+		self._compressed = None
+	
+	def __repr__(self):
+		return "SparseComposition(shape=%r, floor=%r, nnz=%d)" % (self.shape,
+			self.floor, self.nnz)
+	
+	@classmethod
+	def from_dense(cls, matrix, floor=0.0):
+		"""Build a sparse copy of a dense 2D Numpy array."""
+		
+		sparse = cls(matrix.shape, floor, matrix.dtype)
+		for row, values in enumerate(matrix):
+			sparse.set_row(row, values)
+		
+		return sparse
+	
+	def set_row(self, row, values):
+		"""Replace one row with the values above the floor from a 1D array."""
+		
+		values = np.asarray(values)
+		keep = np.flatnonzero(np.abs(values) > self.floor)
+		self._rows[row] = (keep.astype(np.int32),
+			values[keep].astype(self.dtype))
+		self._compressed = None
+	
+	def _compress(self):
+		"""Return the data, indices and indptr arrays for the whole matrix,
+		joining the rows together if anything has changed since last time.
+		The rows then become views of the joined arrays, so that nothing is
+		stored twice.
+		"""
+		
+		if self._compressed is None:
+			counts = [len(indices) for indices, data in self._rows]
+			indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+			np.cumsum(counts, out=indptr[1:])
+			indices = np.concatenate([indices for indices, _ in self._rows])
+			data = np.concatenate([data for _, data in self._rows])
+			self._rows = [(indices[start:stop], data[start:stop])
+				for start, stop in zip(indptr[:-1], indptr[1:])]
+			self._compressed = (data, indices, indptr)
+		
+		return self._compressed
+	
+	@property
+	def nnz(self):
+		"""Number of values actually stored."""
+		
+		return sum(len(data) for _, data in self._rows)
+	
+	@property
+	def nbytes(self):
+		"""Number of bytes taken up by the stored values and their indices."""
+		
+		data, indices, indptr = self._compress()
+		return data.nbytes + indices.nbytes + indptr.nbytes
+	
+	def row(self, row):
+		"""Return one row as a dense 1D Numpy array."""
+		
+		indices, data = self._rows[row]
+		dense = np.zeros(self.shape[1], dtype=self.dtype)
+		dense[indices] = data
+		
+		return dense
+	
+	def toarray(self):
+		"""Return the whole matrix as a dense 2D Numpy array."""
+		
+		data, indices, indptr = self._compress()
+		dense = np.zeros(self.shape, dtype=self.dtype)
+		rows = np.repeat(np.arange(self.shape[0]), np.diff(indptr))
+		dense[rows, indices] = data
+		
+		return dense
+	
+	def astype(self, dtype):
+		"""Return a copy with the values converted to the given dtype."""
+		
+		sparse = SparseComposition(self.shape, self.floor, dtype)
+		sparse._rows = [(indices, data.astype(dtype))
+			for indices, data in self._rows]
+		
+		return sparse
+	
+	def __rmatmul__(self, weights):
+		"""Return weights @ self, where weights has one value per row (or one
+		row of values per row, for a 2D array), summing up each column in one
+		bincount over all of the stored values.
+		"""
+		
+		data, indices, indptr = self._compress()
+		weights = np.asarray(weights)
+		rows = np.repeat(np.arange(self.shape[0]), np.diff(indptr))
+		columns = self.shape[1]
+		
+		if weights.ndim == 1:
+			return np.bincount(indices, weights=weights[rows] * data,
+				minlength=columns).astype(self.dtype, copy=False)
+		
+		# Every row of weights gets its own stretch of columns to sum into
+		groups = len(weights)
+		offsets = (np.arange(groups) * columns)[:, np.newaxis]
+		totals = np.bincount((offsets + indices).ravel(),
+			weights=(weights[:, rows] * data).ravel(),
+			minlength=groups * columns)
+		
+		return totals.reshape(groups, columns).astype(self.dtype, copy=False)
 
 
 # MAIN TYCHOMODEL CLASS
 #######################
 
+class _DeferredBlock(object):
+	"""Placeholder for a block of floats in a Tycho model file that has been
+	located but not parsed yet. Stores the range where the block was found.
+	"""
+	
+	__slots__ = ("start", "stop")
+	
+	def __init__(self, start, stop):
+		self.start = start
+		self.stop = stop
+
+class _SparseRow(object):
+	"""Placeholder for an isotope's mass fractions, which are stored as a row
+	of a SparseComposition instead. Stores which row it is.
+	"""
+	
+	__slots__ = ("row",)
+	
+	def __init__(self, row):
+		self.row = row
+
 class TychoModel(OrderedDict):
 	"""An OrderedDict subclass for reading Tycho model files into an organized
 	series of labeled Numpy arrays for easy data exploration and processing.
@@ -126,30 +915,314 @@ class TychoModel(OrderedDict):
 	change the contents of the Tycho model file it was read from.
 	"""
 	
-	def __init__(self, filename):
+	def __init__(self, filename, lazy=False, header_only=False, cache=None,
+			fields=None, exclude=None, dtype=np.float64, stats=None,
+			layout=None, sparse=None, workers=None):
 		"""Initialize a new TychoModel object by reading data from the
-		specified model file.
+		specified model file, which can be compressed with gzip, bzip2 or xz,
+		or be any binary file-like object, like a member of a tar archive.
+		
+		If lazy is True, each block of floats is only converted the first time
+		it's accessed (for plain model files only). If header_only is True,
+		reading stops at the end of the header. The cache can be True or a
+		ModelCache to save the parsed arrays in, or load them from.
+		
+		Only the keys in fields get read, and any in exclude get skipped.
+		Floats are stored with the given dtype. If stats is True (or a
+		function to call with them), parse stats are kept in
+		self.parse_stats.
+		
+		A layout from another model file of the same run saves finding the
+		blocks again. A number for sparse is the floor for keeping the isotope
+		mass fractions in a SparseComposition. The workers can be a number of
+		processes or an Executor to convert the blocks of floats on.
 		"""
 		
 		# Initialize self as an OrderedDict and set up the header OrderedDict
+		# File-like objects go by their name only if it's really theirs
 		super(TychoModel, self).__init__()
-		self.header = OrderedDict()
+		self._setup(source_name(filename), dtype)
+		self._floor = sparse
+		
+		# Only collect stats when someone's going to look at them
+		if stats or logger.isEnabledFor(logging.DEBUG):
+			self.parse_stats = ParseStats()
+			self.parse_stats.models = 1
+			start = time.perf_counter()
+		
+		self._load(filename, lazy, header_only, cache, fields, exclude, dtype,
+			layout, workers)
+		
+		# Pass the stats along
+		if self.parse_stats is not None:
+			self.parse_stats.total_time = time.perf_counter() - start
+			if callable(stats):
+				stats(self.parse_stats)
+			logger.debug("parsed %s in %.6f s", self.filename,
+				self.parse_stats.total_time,
+				extra={"parse_stats": self.parse_stats})
+	
+	def _load(self, filename, lazy, header_only, cache, fields, exclude,
+			dtype, layout, workers=None):
+		"""Read the data for a new TychoModel object, with the same arguments
+		as __init__.
+		"""
+		
+		# Only read as far as the first blank line if the header is all we need
+		if header_only:
+			self.header.update(read_header(filename))
+			return
+		
+		# Cache entries are looked up by file name, so there has to be one
+		if cache and hasattr(filename, "read"):
+			raise ValueError("models read from file-like objects can't be "
+				+ "cached")
+		
+		# Figure out which keys to read from the file
+		wanted = field_filter(fields, exclude)
+		
+		# Use the cached copy of the model if there's a valid one available
+		# The cache always holds full precision and the whole dense matrix, so
+		# convert afterward if needed
+		floor = self._floor
+		if cache is True:
+			cache = ModelCache()
+		if cache:
+			self._dtype = np.dtype(np.float64)
+			self._floor = None
+			if cache.load(self, wanted):
+				self._sparsify(floor)
+				self._cast(dtype)
+				if self.parse_stats is not None:
+					self.parse_stats.cache_hits += 1
+				return
+		
+		# Map the contents of the model file, unless it has to be streamed
+		stream = open_stream(filename)
+		lazy = lazy and stream is None
+		source = map_file(filename) if stream is None else stream
+		
+		# Keep the contents around in lazy mode to parse blocks from later
+		self._source = source if lazy else None
+		
+		# Start up a pool of processes for converting floats if asked to
+		pool = None
+		if isinstance(workers, Executor):
+			pool = workers
+		elif workers is not None and workers > 1 and not lazy:
+			pool = ProcessPoolExecutor(max_workers=workers)
+		
+		# Read everything, then let go of the file unless it's still needed
+		# The cache needs every array parsed, so ignore the fields in that case
+		try:
+			spans = None
+			if layout is not None and stream is None:
+				spans = layout.match(source)
+			self._read(source, lazy, None if cache else wanted, spans,
+				None if lazy else pool)
+		finally:
+			if stream is not None:
+				close_stream(stream, filename)
+			elif self._source is None:
+				unmap_file(source)
+			if pool is not None and pool is not workers:
+				pool.shutdown()
+		
+		# Save to the cache, then drop whatever wasn't asked for after all
+		if cache:
+			self._resolve_all()
+			cache.store(self)
+			for label in list(self.keys()):
+				if not wanted(label):
+					del self[label]
+			self._sparsify(floor)
+			self._cast(dtype)
+	
+	def _setup(self, filename, dtype):
+		"""Set up all of the attributes that an empty TychoModel needs."""
 		
-		# Save the name of the Tycho model file and read its contents
+		# Save the name of the Tycho model file
+		self.header = OrderedDict()
 		self.filename = filename
-		with open(self.filename, "r") as modelfile:
-			modelstring = modelfile.read()
+		self._source = None
+		self.parse_stats = None
+		
+		# Derived quantities get memoized here as they're computed
+		self._derived = {}
+		
+		# Positions of the isotopes by name, and the array they were found in
+		self._isotope_index = OrderedDict()
+		self._indexed = None
+		
+		# Isotopes on the list that had no block in the model file, or None if
+		# the model wasn't read straight from one
+		self._missing = None
+		
+		# Isotope mass fractions live together in one matrix, and _rows tells
+		# which row each isotope gets, but only if all of them are being read
+		# In sparse mode, the matrix is a SparseComposition kept in _sparse,
+		# with _floor as the smallest magnitude that gets stored
+		self._dtype = np.dtype(dtype)
+		self._composition = None
+		self._sparse = None
+		self._floor = None
+		self._rows = OrderedDict()
+	
+	@classmethod
+	def from_arrays(cls, filename, header, arrays, composition=None,
+			rows=None):
+		"""Build a TychoModel out of a header and arrays that have already been
+		parsed from the given model file somewhere else, without reading it.
+		Both header and arrays should be ordered mappings or (key, value)
+		pairs in the same order that they appear in the file. Optionally,
+		composition can be a 2D composition matrix and rows a mapping from
+		isotope names to rows of it. Arrays given as None are then taken to be
+		views of their isotope's row in the matrix.
+		"""
 		
-		# Use the Tycho re pattern to classify all block of data in the file
-		matches = re.finditer(TYCHO_PATTERN, modelstring, flags=re.MULTILINE)
+		# Skip __init__ entirely, since that would read the model file
+		model = cls.__new__(cls)
+		super(TychoModel, model).__init__()
+		model._setup(filename, np.float64)
+		model._fill(header, arrays, composition, rows)
+		
+		return model
+	
+	def _fill(self, header, arrays, composition=None, rows=None):
+		"""Fill in a header and arrays that were parsed somewhere else, as
+		described for from_arrays.
+		"""
+		
+		self.header.update(header)
+		
+		# Set up the composition matrix first
+		self._rows = OrderedDict(rows or ())
+		self._composition = composition
+		if composition is not None:
+			self._dtype = composition.dtype
+		
+		# Fill in the arrays in order, pointing them at the matrix where needed
+		for label, value in OrderedDict(arrays).items():
+			if value is None:
+				value = composition[self._rows[label]]
+				super(TychoModel, self).__setitem__(label, value)
+			else:
+				self[label] = value
+	
+	def _export(self):
+		"""Return the header, arrays, composition matrix and isotope rows of
+		this model in the form that _fill takes them, with each array that is
+		just a view of the composition matrix replaced by None.
+		"""
+		
+		self._resolve_all()
+		arrays = []
+		for label, value in super(TychoModel, self).items():
+			if self._is_row(label, value):
+				value = None
+			arrays.append((label, value))
+		
+		# A sparse matrix gets written out in full
+		composition = self._composition
+		if self._sparse is not None:
+			composition = self._sparse.toarray()
+		
+		return list(self.header.items()), arrays, composition, \
+			list(self._rows.items())
+	
+	def _is_row(self, label, value):
+		"""Return whether the given array is a view of the composition matrix,
+		or a placeholder for a row of the sparse one.
+		"""
+		
+		if isinstance(value, _SparseRow):
+			return True
+		
+		return self._composition is not None and label in self._rows \
+			and np.may_share_memory(value, self._composition)
+	
+	def _sparsify(self, floor=None):
+		"""Switch to storing the composition matrix as a SparseComposition with
+		the given floor, if there is one, replacing each isotope's view of the
+		dense matrix with a placeholder for its row of the sparse one.
+		"""
+		
+		self._floor = floor
+		if floor is None or self._composition is None:
+			return
+		
+		self._sparse = SparseComposition.from_dense(self._composition, floor)
+		for label, value in list(super(TychoModel, self).items()):
+			if label in self._rows and self._is_row(label, value):
+				row = _SparseRow(self._rows[label])
+				super(TychoModel, self).__setitem__(label, row)
+		self._composition = None
+		self._derived.clear()
+	
+	def _cast(self, dtype):
+		"""Convert every floating point array in the model to the given dtype,
+		including the composition matrix.
+		"""
+		
+		# Nothing to do if the arrays are already the right type
+		dtype = np.dtype(dtype)
+		if dtype == self._dtype:
+			return
+		self._dtype = dtype
+		self._derived.clear()
+		
+		# Convert the composition matrix and all of the other float arrays
+		old = self._composition
+		if old is not None:
+			self._composition = old.astype(dtype)
+		if self._sparse is not None:
+			self._sparse = self._sparse.astype(dtype)
+		for label, value in list(super(TychoModel, self).items()):
+			if isinstance(value, np.ndarray) and value.dtype.kind == "f":
+				if old is not None and label in self._rows \
+						and np.may_share_memory(value, old):
+					value = self._composition[self._rows[label]]
+				else:
+					value = value.astype(dtype)
+				super(TychoModel, self).__setitem__(label, value)
+	
+	def _read(self, source, lazy, wanted=None, spans=None, pool=None):
+		"""Classify all of the data in a model file and process each block.
+		The source is either the whole contents of the file or a stream to
+		read it from in chunks. Only the blocks that actually get parsed are
+		ever copied out of the file contents or decoded. If wanted is given,
+		it's a function that says which keys to parse, and all other blocks
+		are skipped. If spans is given, it's a list of every block in the
+		contents that has already been found (by ModelLayout.match). If pool
+		is an Executor, then the blocks of floats get sent off to it to be
+		converted, and collected again in order at the end.
+		"""
+		
+		# Classify the blocks of data all at once, or chunk by chunk
+		stats = self.parse_stats
+		if isinstance(source, (bytes, mmap.mmap)):
+			if spans is None:
+				spans = scan_blocks(source)
+			blocks = ((classified, source, start, stop)
+				for classified, start, stop in spans)
+			if stats is not None:
+				stats.bytes_scanned += len(source)
+		else:
+			blocks = stream_blocks(source, stats=stats)
 		
 		# Loop over the data blocks and process each of them depending on type
 		label_without_data = None  # Record any label waiting for data
-		for match in matches:
+		found = set()  # Record every key found, even ones that were skipped
+		pending = []  # Record each block of floats sent off to the pool
+		if stats is not None:
+			last = time.perf_counter()
+		for classified, contents, start, stop in blocks:
 			
-			# Extract the text of the match and how it was classified
-			text = match.group()
-			classified = match.lastgroup
+			# Everything since the end of the last block went into finding this
+			if stats is not None:
+				now = time.perf_counter()
+				stats.scan_time += now - last
+				last = now
 			
 			# If the last thing was a label, then this had better be floats
 			if label_without_data is not None and classified != "FLOAT":
@@ -159,29 +1232,42 @@ class TychoModel(OrderedDict):
 			
 			# Choose our parsing approach depending on the data classification
 			if classified == "FIRST":
-				self._parse_first(text)
+				self._parse_first(contents[start:stop].decode())
 			elif classified == "HEADER":
-				self._parse_header(text)
+				self._parse_header(contents[start:stop].decode())
 			elif classified == "LABEL":
-				label_without_data = text.strip()
+				label_without_data = contents[start:stop].decode().strip()
 			elif classified == "FLOAT":
 				if label_without_data is not None:
-					self._parse_float(text, label_without_data)
+					label = label_without_data
 					label_without_data = None
-				elif "initial composition" not in self:
-					self._parse_float(text, "initial composition")
+				elif "initial composition" not in found:
+					label = "initial composition"
 				else:
 					msg = "found a secondary unlabeled block of floats"
 					raise SyntaxError(msg)
+				found.add(label)
+				if wanted is not None and not wanted(label):
+					pass  # Skip this block without parsing it
+				elif lazy:
+					self._defer_float((start, stop), label)
+				elif pool is not None:
+					pending.append(self._submit_float(pool,
+						contents[start:stop], label))
+				else:
+					self._parse_float(contents[start:stop], label)
 			elif classified == "INT":
-				if ("nz" not in self) and ("nn" not in self):
-					self._parse_int(text, ["nz", "nn"])
+				if ("nz" not in found) and ("nn" not in found):
+					found.update(["nz", "nn"])
+					self._parse_int(contents[start:stop].decode(), ["nz", "nn"])
 				else:
 					msg = "found an additional block of unlabeled ints"
 					raise SyntaxError(msg)
 			elif classified == "ISOTOPE":
-				if "isotope" not in self:
-					self._parse_isotope(text, "isotope")
+				if "isotope" not in found:
+					found.add("isotope")
+					self._parse_isotope(contents[start:stop].decode(), "isotope")
+					self._stack_isotopes(wanted)
 				else:
 					msg = "found a secondary block of isotope names"
 					raise SyntaxError(msg)
@@ -191,59 +1277,211 @@ class TychoModel(OrderedDict):
 				msg = "unexpected data block classification: " \
 					+ str(classified)
 				raise ValueError(msg)
+			
+			# Then everything since then went into processing it
+			if stats is not None:
+				now = time.perf_counter()
+				stats.counts[classified] += 1
+				stats.nbytes[classified] += stop - start
+				stats.times[classified] += now - last
+				last = now
 		
 		# Make sure there isn't a remaining label without data
 		if label_without_data is not None:
 			msg = "model file ended while waiting for incoming data"
 			raise SyntaxError(msg)
+		
+		# Fill in the blocks from the pool, which already have their places
+		for label, future in pending:
+			self._collect_float(label, future)
+		
+		# Note any isotopes (or the whole list) that never turned up, even if
+		# they weren't going to be read anyway
+		if "isotope" in self:
+			self._missing = [str(name) for name in self["isotope"]
+				if str(name) not in found]
+		else:
+			self._missing = ["isotope"]
+		
+		# The unlabeled ints and isotopes are always small enough to parse, but
+		# get rid of them now if they weren't wanted
+		if wanted is not None:
+			for label in ["nz", "nn", "isotope"]:
+				if label in self and not wanted(label):
+					del self[label]
 	
 	def _parse_first(self, string):
 		"""Parse the first line of the model file."""
 		
-		# Split the first line string into bit at any amount of whitespace
-		# WEIRD EDGE CASE: the third thing on this line is the simulation file
-		# prefix, which is usually just two characters. However, if the model
-		# file is an imodel that was just generated, the prefix will be the
-		# three-character string "new", which will abut the version number (the
-		# second thing on this line). In this situation, we need to add some
-		# whitespace in between before splitting the string. I originally tried
-		# to solve this by using a zero-length splitter in re.split, but that
-		# raises a FutureWarning in Python 3 apparently.
-		string = re.sub(r"([0-9]+\.[0-9]+)(new )", r"\1 \2", string.strip())
-		bits = re.split(r" +", string.strip())
-		
-		for i, bit in enumerate(bits):
-			
-			# Convert the bit to an int or a float if appropriate
-			# Store the bits in the header dict by their ordered index
-			self.header[i] = convert(bit)
+		parse_first(string, self.header)
 	
 	def _parse_header(self, string):
 		"""Parse the header of the model file, not including the first line."""
 		
-		# Extract the variable name and value from each header line
-		pattern = r"^ *(" + STR_PAT + r") {2,}(" + STR_PAT + r") *$"
-		matches = re.finditer(pattern, string.strip(), flags=re.MULTILINE)
-		
-		for match in matches:
-			
-			name, value = match.group(1, 2)
-			
-			# Convert the value to an int or a float if appropriate
-			# Save value to the header dict using the variable name as the key
-			self.header[str(name)] = convert(value)
+		parse_header(string, self.header)
 	
 	def _parse_float(self, string, label):
 		"""Parse a multiline block of floating point values and store the final
 		Numpy array under self[label].
 		"""
 		
-		# Use re to extract everything that looks like a float
-		matches = re.finditer(FLT_PAT, string.strip(), flags=re.MULTILINE)
-		floats = [match.group() for match in matches]
+		# Convert the entire block of floats at once
+		stats = self.parse_stats
+		if stats is not None:
+			start = time.perf_counter()
+		values = recover_floats(string, stats).astype(self._dtype, copy=False)
+		
+		# Index using the given label, eliminate any weird str subclasses
+		self[str(label)] = values
+		if stats is not None:
+			stats.convert_time += time.perf_counter() - start
+	
+	def _submit_float(self, pool, string, label):
+		"""Send a multiline block of floating point values off to a pool to be
+		converted, holding its place under self[label] in the meantime, and
+		return the label and the future for the array.
+		"""
+		
+		# Index using the given label, eliminate any weird str subclasses
+		label = str(label)
+		super(TychoModel, self).__setitem__(label, None)
+		future = pool.submit(_convert_block, string, self._dtype,
+			self.parse_stats is not None)
+		
+		return label, future
+	
+	def _collect_float(self, label, future):
+		"""Wait for a block of floats sent off by _submit_float, and store the
+		final Numpy array under self[label].
+		"""
+		
+		stats = self.parse_stats
+		if stats is not None:
+			start = time.perf_counter()
+		values, block_stats = future.result()
+		self[label] = values
+		
+		# Only the time spent waiting counts, since the rest was in parallel
+		if stats is not None:
+			stats.convert_time += time.perf_counter() - start
+			stats.floats += block_stats.floats
+			stats.repaired_floats += block_stats.repaired_floats
+			stats.fallback_blocks += block_stats.fallback_blocks
+	
+	def _defer_float(self, span, label):
+		"""Record where a block of floating point values sits in the model file
+		without parsing it, leaving a placeholder under self[label].
+		"""
 		
 		# Index using the given label, eliminate any weird str subclasses
-		self[str(label)] = np.array([recover_float(f) for f in floats])
+		super(TychoModel, self).__setitem__(str(label), _DeferredBlock(*span))
+	
+	def _resolve(self, label, value):
+		"""If value is a placeholder for a block of floats that has not been
+		parsed yet, then parse it now and return the new Numpy array.
+		Otherwise, just return value unchanged.
+		"""
+		
+		if isinstance(value, _DeferredBlock):
+			self._parse_float(self._source[value.start:value.stop], label)
+			value = super(TychoModel, self).__getitem__(label)
+		
+		# Rows of a sparse matrix are only ever handed out as dense copies
+		if isinstance(value, _SparseRow):
+			value = self._sparse.row(value.row)
+		
+		return value
+	
+	def _resolve_all(self):
+		"""Parse every block of floats that is still waiting to be parsed."""
+		
+		if self._source is not None:
+			for label in self.keys():
+				self[label]  # The lookup does all the work
+			unmap_file(self._source)
+			self._source = None  # Not needed anymore, let it be freed
+	
+	def __getitem__(self, key):
+		value = super(TychoModel, self).__getitem__(key)
+		return self._resolve(key, value)
+	
+	def __setitem__(self, key, value):
+		
+		# An isotope's mass fractions get copied into its row of the matrix
+		# (which is created the first time it's needed) as long as they fit
+		row = self._rows.get(key)
+		if row is not None and isinstance(value, np.ndarray) \
+				and value.ndim == 1 and self._floor is not None:
+			if self._sparse is None:
+				shape = (max(self._rows.values()) + 1, len(value))
+				self._sparse = SparseComposition(shape, self._floor,
+					self._dtype)
+			if self._sparse.shape[1] == len(value):
+				self._sparse.set_row(row, value)
+				value = _SparseRow(row)
+		elif row is not None and isinstance(value, np.ndarray) \
+				and value.ndim == 1:
+			if self._composition is None:
+				shape = (max(self._rows.values()) + 1, len(value))
+				self._composition = np.full(shape, np.nan, dtype=self._dtype)
+			if self._composition.shape[1] == len(value):
+				self._composition[row] = value
+				value = self._composition[row]
+		
+		super(TychoModel, self).__setitem__(key, value)
+		self._invalidate(key)
+	
+	def __delitem__(self, key):
+		super(TychoModel, self).__delitem__(key)
+		self._invalidate(key)
+	
+	def clear(self):
+		"""Remove every key, and let go of the composition matrix, any derived
+		quantities and the memory map from lazy mode as well, so that nothing
+		but the header is left taking up memory.
+		"""
+		
+		super(TychoModel, self).clear()
+		if self._source is not None:
+			unmap_file(self._source)
+			self._source = None
+		self._composition = None
+		self._sparse = None
+		self._derived.clear()
+	
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		else:
+			return default
+	
+	def pop(self, key, *args):
+		if key in self:
+			value = self[key]
+			del self[key]
+			return value
+		return super(TychoModel, self).pop(key, *args)
+	
+	def popitem(self, last=True):
+		self._resolve_all()
+		key, value = super(TychoModel, self).popitem(last)
+		self._invalidate(key)
+		return key, self._resolve(key, value)
+	
+	# Sparse rows have to be turned into arrays on the way out, so that takes
+	# a list instead of a view
+	
+	def values(self):
+		self._resolve_all()
+		if self._sparse is not None:
+			return [self[key] for key in self.keys()]
+		return super(TychoModel, self).values()
+	
+	def items(self):
+		self._resolve_all()
+		if self._sparse is not None:
+			return [(key, self[key]) for key in self.keys()]
+		return super(TychoModel, self).items()
 	
 	def _parse_int(self, string, labels):
 		"""Parse a multiline block of integer values (possibly made up of 2 or
@@ -285,6 +1523,324 @@ class TychoModel(OrderedDict):
 		# Index using the given label, eliminate any weird str subclasses
 		self[str(label)] = np.array([str(iso) for iso in isotopes], dtype="U")
 	
+	def _stack_isotopes(self, wanted=None):
+		"""Assign each isotope in self["isotope"] a row of the composition
+		matrix, as long as all of them are going to be read. If only some of
+		them are wanted, they'll just be stored as separate arrays instead.
+		"""
+		
+		names = [str(name) for name in self["isotope"]]
+		if wanted is None or all(wanted(name) for name in names):
+			self._rows = OrderedDict((name, i) for i, name in enumerate(names))
+	
+	@property
+	def isotope_index(self):
+		"""OrderedDict mapping each isotope name to its position in
+		self["isotope"] (and in self["nz"] and self["nn"]), which is only
+		built again when self["isotope"] gets replaced.
+		"""
+		
+		isotopes = super(TychoModel, self).get("isotope")
+		if isotopes is not self._indexed:
+			self._indexed = isotopes
+			self._isotope_index = OrderedDict() if isotopes is None \
+				else OrderedDict((str(name), i) for i, name in enumerate(isotopes))
+		
+		return self._isotope_index
+	
+	def nuclear_numbers(self, isotope):
+		"""Return the proton number nz and neutron number nn of an isotope."""
+		
+		try:
+			i = self.isotope_index[isotope]
+		except KeyError:
+			msg = "isotope " + repr(isotope) + " is not in model file"
+			raise KeyError(msg)
+		
+		return int(self["nz"][i]), int(self["nn"][i])
+	
+	def _parse_rows(self):
+		"""Make sure that every row of the composition matrix is filled in,
+		since lazy mode might not have parsed all of them yet.
+		"""
+		
+		if self._source is not None:
+			for label in self._rows:
+				value = super(TychoModel, self).get(label)
+				if isinstance(value, _DeferredBlock):
+					self._resolve(label, value)
+	
+	@property
+	def composition(self):
+		"""Contiguous 2D Numpy array of the mass fractions of every isotope in
+		every zone, with one row per entry of self["isotope"], or None if the
+		isotopes weren't all read. Each self[isotope] is a view of its row,
+		except in sparse mode, where this is a new dense copy every time.
+		"""
+		
+		self._parse_rows()
+		if self._sparse is not None:
+			return self._sparse.toarray()
+		
+		return self._composition
+	
+	@property
+	def sparse_composition(self):
+		"""The SparseComposition holding the mass fractions of every isotope in
+		sparse mode, or None otherwise.
+		"""
+		
+		self._parse_rows()
+		return self._sparse
+	
+	def derived(self, name):
+		"""Return the array for the given key, or if the model file doesn't
+		have one, compute it from DERIVED_QUANTITIES. Derived quantities are
+		only computed the first time they're asked for, and then remembered
+		until one of the arrays that they depend on gets replaced or deleted.
+		Changing the values inside an array in place doesn't count, so call
+		clear_derived after doing that.
+		"""
+		
+		# Anything actually in the model comes first
+		if name in self:
+			return self[name]
+		
+		# Then anything already computed
+		value = self._derived.get(name)
+		if value is not None:
+			return value
+		
+		# Otherwise, figure it out now
+		if name not in DERIVED_QUANTITIES:
+			msg = "quantity " + repr(name) + " is not in file and can't be " \
+				+ "derived"
+			raise KeyError(msg)
+		value = DERIVED_QUANTITIES[name][1](self)
+		self._derived[name] = value
+		
+		return value
+	
+	def clear_derived(self):
+		"""Forget every derived quantity that has been computed so far."""
+		
+		self._derived.clear()
+	
+	def _invalidate(self, key):
+		"""Forget any derived quantities that depend on the given key, after
+		its array has been replaced or deleted.
+		"""
+		
+		# Nothing to do in the usual case of nothing derived yet
+		if not self._derived:
+			return
+		
+		# Isotopes, and the nz and nn arrays, all count as the composition
+		changed = set([key])
+		if key in ["isotope", "nz", "nn"] or key in self.isotope_index:
+			changed.add("composition")
+		
+		for name in list(self._derived):
+			if name == key or derived_dependencies(name) & changed:
+				del self._derived[name]
+	
+	def _mass_fractions(self):
+		"""Return a 2D Numpy array of the mass fractions of each isotope, in
+		the same layout as the composition matrix, along with float arrays of
+		their nz and of 1/A. Anything on the isotope list with no nucleons at
+		all (like Ye) gets 1/A = 0, so that it drops out of any sums weighted
+		by it without having to copy the matrix to leave it out.
+		"""
+		
+		try:
+			names = [str(name) for name in self["isotope"]]
+			nz = self["nz"].astype(self._dtype)
+			nn = self["nn"].astype(self._dtype)
+		except KeyError:
+			msg = "cannot derive from composition, isotopes not in model"
+			raise KeyError(msg)
+		
+		# Use the composition matrix when there is one, to avoid any copying
+		# A sparse one works just as well, since it only gets multiplied
+		fractions = self.sparse_composition
+		if fractions is None:
+			fractions = self.composition
+		if fractions is None:
+			fractions = np.array([self[name] for name in names])
+		
+		mass = nz + nn
+		inverse = np.divide(1.0, mass, out=np.zeros_like(mass), where=mass > 0)
+		
+		return fractions, nz, inverse
+	
+	def _sum_fractions(self, keys):
+		"""Return the distinct values of keys, which gives a number for each
+		isotope from its nz and nn, along with a 2D Numpy array of the mass
+		fractions of all the isotopes sharing each value summed together, all
+		in one matrix product. Anything with no nucleons (like Ye) is left out
+		before keys ever sees it.
+		"""
+		
+		fractions, nz, inverse = self._mass_fractions()
+		nuclei = np.flatnonzero(inverse)
+		keys = keys(self["nz"][nuclei], self["nn"][nuclei])
+		values, groups = np.unique(np.rint(keys).astype(int),
+			return_inverse=True)
+		members = np.zeros((len(values), len(nz)), dtype=fractions.dtype)
+		members[groups, nuclei] = 1.0
+		
+		return values, members @ fractions
+	
+	def element_fractions(self):
+		"""Return a Numpy array of the proton numbers of every element in the
+		network, along with a 2D Numpy array of the total mass fraction of each
+		element in every zone, with one row per element.
+		"""
+		
+		return self._sum_fractions(lambda nz, nn: nz)
+	
+	def mass_number_fractions(self):
+		"""Return a Numpy array of the mass numbers A found in the network,
+		along with a 2D Numpy array of the total mass fraction of each A in
+		every zone, with one row per A.
+		"""
+		
+		return self._sum_fractions(lambda nz, nn: nz + nn)
+	
+	def is_complete(self):
+		"""Return whether the model file looks like it was all there when it
+		was read, as far as can be told, which is useful for files that might
+		still be in the middle of being written. It has to start with a TYCHO
+		first line, every isotope on the list has to have a block of its own
+		(whether or not it was read), and a plain model file has to end with
+		the blank line that Tycho always finishes them with. Compressed files
+		that got cut off already fail to decompress.
+		"""
+		
+		# Anything that happens to read fine isn't necessarily a model file
+		if self.header.get(0) != "TYCHO":
+			return False
+		
+		# Every isotope has a block of its own after the list of them
+		missing = self._missing
+		if missing is None:
+			missing = [name for name in self.isotope_index if name not in self]
+		if missing:
+			return False
+		
+		# Plain model files end with a blank line
+		if self.filename is None:
+			return True
+		with open(self.filename, "rb") as openfile:
+			head = openfile.read(2)
+			size = os.fstat(openfile.fileno()).st_size
+			openfile.seek(max(size - TAIL_SIZE, 0))
+			tail = openfile.read()
+		
+		return head != b"TY" or tail.rstrip(b" \t\r").endswith(b"\n\n")
+	
+	def memory_usage(self):
+		"""Return the total number of bytes taken up by all of the arrays in
+		this model, counting the composition matrix once instead of once per
+		isotope (and only the values actually stored, if it's sparse). Blocks
+		that lazy mode hasn't parsed yet don't count.
+		"""
+		
+		total = 0
+		if self._composition is not None:
+			total += self._composition.nbytes
+		if self._sparse is not None:
+			total += self._sparse.nbytes
+		for label, value in super(TychoModel, self).items():
+			if isinstance(value, np.ndarray) and not self._is_row(label, value):
+				total += value.nbytes
+		
+		return total
+	
+	def write(self, path):
+		"""Write this model out to a new Tycho model file at the given path,
+		compressed if the path ends in .gz, .bz2 or .xz, in a layout that
+		reads back in as an identical model. Floats are written with enough
+		digits to come back exactly. Labels and header entries need to be
+		strings without any double spaces, and every array needs at least two
+		finite values, so that they can all be told apart again when read.
+		"""
+		
+		# Everything that gets written as a string has to read back the same
+		def check_string(kind, string):
+			string = str(string)
+			if not re.match("^" + STR_PAT + "$", string):
+				msg = "can't write " + kind + " " + repr(string)
+				raise ValueError(msg)
+			return string
+		
+		chunks = []
+		
+		# First line, which is stored in the header by its ordered index
+		first = [value for key, value in self.header.items()
+			if isinstance(key, int)]
+		if first:
+			chunks.append(" ".join(str(value) for value in first) + "\n")
+		
+		# The rest of the header, which has to be more than just one line
+		header = [(check_string("header name", key),
+			check_string("header value", value))
+			for key, value in self.header.items() if not isinstance(key, int)]
+		if len(header) == 1:
+			msg = "can't write a header with only one entry"
+			raise ValueError(msg)
+		for name, value in header:
+			chunks.append(" %s  %s\n" % (name.ljust(29), value))
+		chunks.append("\n\n")
+		
+		# Then every array in order, with a label if it needs one
+		previous = None
+		for label, value in self.items():
+			if label == "nz" or label == "nn":
+				if label == "nn":
+					continue  # Both get written together in one block
+				if "nn" not in self:
+					msg = "can't write nz without nn"
+					raise ValueError(msg)
+				ints = np.concatenate([self["nz"], self["nn"]]).tolist()
+				chunks.append(format_block(INT_FORMAT, ints, INTS_PER_LINE))
+				previous = "INT"
+			elif label == "isotope":
+				names = [check_string("isotope name", name) for name in value]
+				chunks.append(format_block(ISOTOPE_FORMAT, names,
+					ISOTOPES_PER_LINE))
+				previous = "ISOTOPE"
+			else:
+				values = np.asarray(value, dtype=np.float64)
+				if not np.all(np.isfinite(values)):
+					msg = "can't write non-finite values in " + repr(label)
+					raise ValueError(msg)
+				
+				# Unlabeled floats need a blank line to stay apart from others
+				if label == "initial composition":
+					if previous == "FLOAT":
+						chunks.append("\n")
+				else:
+					label = check_string("label", label)
+					if re.match("^" + LINE_PATTERNS["FLOAT"] + "$", label):
+						msg = "can't write label " + repr(label)
+						raise ValueError(msg)
+					
+					# Most labels would pass for one more line of isotopes
+					if previous == "ISOTOPE":
+						chunks.append("\n")
+					chunks.append(" " + label + "\n")
+				chunks.append(format_block(FLOAT_FORMAT, values.ravel().tolist(),
+					FLOATS_PER_LINE))
+				previous = "FLOAT"
+		chunks.append("\n\n")
+		
+		# Write it all out, compressed if the file name says so
+		opener = COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1], open)
+		with opener(path, "wb") as openfile:
+			for chunk in chunks:
+				openfile.write(chunk.encode())
+	
 	def __repr__(self):
 		return "TychoModel(" + repr(self.filename) + ")"
 	
@@ -315,11 +1871,12 @@ class TychoModel(OrderedDict):
 		
 		# Try and look up the appropriate units in the table
 		# If the quantity is an isotope or Ye, then it's dimensionless
+		table = units_table()
 		try:
-			lookup = UNITS_TABLE[quantity]
+			lookup = table[quantity]
 		except KeyError:
-			if quantity in self["isotope"]:
-				return u.dimensionless_unscaled  # Mass fractions and Ye
+			if quantity in self.isotope_index:
+				return table["initial composition"]  # Mass fractions and Ye
 			else:
 				msg = "quantity " + repr(quantity) + \
 					" not available for units lookup"
@@ -338,15 +1895,242 @@ class TychoModel(OrderedDict):
 		"""
 		
 		try:
-			self["density"] = 1.0 / self["specific volume"]
+			self["density"] = self.derived("density")
 		except KeyError:
 			msg = "cannot calculate density, no specific volume in model file"
 			raise KeyError(msg)
 	
 	def add_internal_energy(self):
-		""""""
+		"""Add an entry for specific internal energy to the OrderedDict self,
+		calculated from the pressure, temperature and density as described in
+		derive_internal_energy.
+		"""
+		
+		try:
+			self["internal energy"] = self.derived("internal energy")
+		except KeyError:
+			msg = "cannot calculate internal energy, no pressure, temperature " \
+				+ "or specific volume in model file"
+			raise KeyError(msg)
+
+
+# BINARY CACHE
+##############
+
+class ModelCache(object):
+	"""A directory full of binary copies of parsed Tycho model files. Each
+	entry is a subdirectory holding one .npy file per array, plus an index
+	with the header, the keys, and the size and modification time of the
+	model file it came from, and the total size of the entry. Entries for
+	model files that have changed since are ignored, and the least recently
+	used entries are deleted whenever the total size of the cache goes over
+	the size limit, which is kept track of as entries are stored.
+	"""
+	
+	def __init__(self, directory=None, size_limit=None):
+		"""Set up a cache in the given directory (created as needed) with the
+		given size limit in bytes. Both default to the module-level settings
+		CACHE_DIR and CACHE_SIZE_LIMIT.
+		"""
+		
+		self.directory = CACHE_DIR if directory is None else directory
+		self.size_limit = CACHE_SIZE_LIMIT if size_limit is None else size_limit
+		self._total = None  # Total size of all entries, once it's been measured
+	
+	def __repr__(self):
+		return "ModelCache(" + repr(self.directory) + ")"
+	
+	def _entry(self, filename):
+		"""Return the path to the cache entry for the given model file."""
+		
+		# Name entries by a hash of the absolute path to the model file
+		path = os.path.abspath(filename).encode("utf-8")
+		return os.path.join(self.directory, hashlib.sha1(path).hexdigest())
+	
+	def _entries(self):
+		"""Return a list of (last used, size, path) for every entry in the
+		cache, skipping anything else in the directory, along with entries
+		that are still being written.
+		"""
+		
+		entries = []
+		for name in os.listdir(self.directory):
+			entry = os.path.join(self.directory, name)
+			size = self._size(entry)
+			if name.startswith(".") or size is None:
+				continue
+			index_file = os.path.join(entry, "index.json")
+			entries.append((os.path.getmtime(index_file), size, entry))
+		
+		return entries
+	
+	def _size(self, entry):
+		"""Return the size of a cache entry as recorded in its index, or None
+		if it isn't an entry at all.
+		"""
+		
+		try:
+			with open(os.path.join(entry, "index.json"), "r") as openfile:
+				index = json.load(openfile)
+		except (IOError, OSError, ValueError):
+			return None
+		
+		# Entries stored before sizes were recorded have to be measured
+		if "size" not in index:
+			return sum(os.path.getsize(os.path.join(entry, name))
+				for name in os.listdir(entry))
+		
+		return index["size"]
+	
+	def load(self, model, wanted=None):
+		"""Fill in the header and arrays of a freshly initialized TychoModel
+		from the cache, if there is an entry for its model file that is still
+		up to date. The arrays are memory-mapped copy-on-write, so they can be
+		modified without changing the cache. If wanted is given, it's a
+		function that says which keys to load. Return whether it worked.
+		"""
+		
+		# Try to read the index for this entry
+		entry = self._entry(model.filename)
+		index_file = os.path.join(entry, "index.json")
+		try:
+			with open(index_file, "r") as openfile:
+				index = json.load(openfile)
+		except (IOError, OSError, ValueError):
+			return False
+		
+		# Make sure that the model file hasn't been changed since
+		stat = os.stat(model.filename)
+		if [stat.st_size, stat.st_mtime_ns] != index["source"]:
+			return False
+		
+		# Map the composition matrix and all of the other arrays, in order
+		# Isotopes that are stored as rows of the matrix don't have own files
+		# Just like reading the model file, the matrix is only kept if every
+		# isotope is wanted, and otherwise they're all separate arrays
+		composition = None
+		rows = OrderedDict(index.get("rows") or ())
+		if index.get("composition"):
+			path = os.path.join(entry, "composition.npy")
+			composition = np.load(path, mmap_mode="c")
+		stacked = composition is not None and (wanted is None
+			or all(wanted(name) for name in rows))
+		arrays = []
+		for i, label in enumerate(index["keys"]):
+			if wanted is not None and not wanted(label):
+				continue
+			elif label in index.get("stacked", ()):
+				arrays.append((label, None if stacked
+					else composition[rows[label]]))
+			else:
+				path = os.path.join(entry, str(i) + ".npy")
+				arrays.append((label, np.load(path, mmap_mode="c")))
+		if not stacked:
+			composition = None
+			rows = None
+		
+		# Copy over the header (JSON lists preserve the int keys) and arrays
+		model._fill(index["header"], arrays, composition, rows)
+		
+		# Note that this entry was just used
+		os.utime(index_file, None)
+		
+		return True
+	
+	def store(self, model):
+		"""Save the header and arrays of a fully parsed TychoModel to the
+		cache, replacing any existing entry for the same model file, and then
+		evict old entries if the cache has gotten too big.
+		"""
+		
+		# Build the new entry in a temporary directory first, so that other
+		# processes never see an entry that is only partially written
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		tempdir = tempfile.mkdtemp(prefix=".", dir=self.directory)
+		
+		try:
+			
+			# Save the composition matrix and each array that isn't part of it
+			# under its position in the model
+			header, arrays, composition, rows = model._export()
+			if composition is not None:
+				path = os.path.join(tempdir, "composition.npy")
+				np.save(path, composition)
+			for i, (label, value) in enumerate(arrays):
+				if value is not None:
+					np.save(os.path.join(tempdir, str(i) + ".npy"), value)
+			size = sum(os.path.getsize(os.path.join(tempdir, name))
+				for name in os.listdir(tempdir))
+			
+			# Write the index last of all
+			stat = os.stat(model.filename)
+			index = {
+				"filename": os.path.abspath(model.filename),
+				"source": [stat.st_size, stat.st_mtime_ns],
+				"header": header,
+				"keys": [label for label, _ in arrays],
+				"stacked": [label for label, value in arrays if value is None],
+				"composition": composition is not None,
+				"rows": rows,
+				"size": size,
+			}
+			with open(os.path.join(tempdir, "index.json"), "w") as openfile:
+				json.dump(index, openfile)
+			
+			# Swap the new entry into place
+			entry = self._entry(model.filename)
+			old_size = 0
+			if os.path.exists(entry):
+				old_size = self._size(entry) or 0
+				shutil.rmtree(entry, ignore_errors=True)
+			os.rename(tempdir, entry)
+			if self._total is not None:
+				self._total += size - old_size
+		
+		# Never leave temporary junk behind, including when another process
+		# has managed to store the same model at the same time
+		except OSError:
+			shutil.rmtree(tempdir, ignore_errors=True)
+		except:
+			shutil.rmtree(tempdir, ignore_errors=True)
+			raise
+		
+		self.evict()
+	
+	def evict(self):
+		"""If the total size of the cache is over the size limit, then delete
+		the least recently used entries until it's down to CACHE_EVICT_TARGET
+		of the limit. The directory is only looked through when the running
+		total says that it's needed (or hasn't been measured yet), since other
+		processes can add entries too.
+		"""
+		
+		if self._total is not None and self._total <= self.size_limit:
+			return
+		
+		# Find out how big each entry is and when it was last used
+		entries = self._entries()
+		total = sum(size for _, size, _ in entries)
+		
+		# Delete entries starting from the oldest until everything fits
+		if total > self.size_limit:
+			for _, size, entry in sorted(entries):
+				if total <= self.size_limit * CACHE_EVICT_TARGET:
+					break
+				shutil.rmtree(entry, ignore_errors=True)
+				total -= size
+		self._total = total
+	
+	def clear(self):
+		"""Delete every entry in the cache, leaving anything else that's in
+		the directory alone.
+		"""
 		
-		raise NotImplemented
+		if os.path.isdir(self.directory):
+			for _, _, entry in self._entries():
+				shutil.rmtree(entry, ignore_errors=True)
+		self._total = None
 
 
 # TEST CODE
@@ -0,0 +1,347 @@
+# tycho_bench.py
+
+# Benchmarks for reading Tycho model files, run on synthetic model files
+# Real model files are big and not something to keep around in the repository,
+# so this writes fake ones with the same layout and any number of zones
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import tycho
+import tycho_legacy
+import tycho_series
+
+# The legacy reader lives in its own directory of scripts without a package
+LEGACY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	"stars_2_code")
+sys.path.insert(0, LEGACY_DIR)
+from tycho_model import TYCHO_Model
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Physical quantities written out for every zone of a synthetic model
+PHYSICS = ["radius", "velocity", "temperature", "specific volume", "pressure",
+	"zone mass", "luminosity", "convection speed"]
+
+# Element symbols by proton number, used to make up isotope names for a
+# synthetic network, starting from the neutron at Z = 0
+ELEMENTS = ["n", "h", "he", "li", "be", "b", "c", "n", "o", "f", "ne", "na",
+	"mg", "al", "si", "p", "s", "cl", "ar", "k", "ca", "sc", "ti", "v", "cr",
+	"mn", "fe", "co", "ni", "cu", "zn"]
+
+# Names that Tycho gives the neutron and the hydrogen isotopes, by (Z, A)
+SPECIAL_NAMES = {(0, 1): "n", (1, 1): "p", (1, 2): "d", (1, 3): "t"}
+
+# Numbers of zones to use when measuring how the scan time grows
+SCAN_SIZES = [250, 500, 1000, 2000, 4000]
+
+
+# SYNTHETIC MODEL FILES
+#######################
+
+def format_floats(values, per_line=5, eless=0.0, rng=np.random):
+	"""Format floats the way Tycho does, five to a line in 15-character
+	fields, as one string with a newline at the end of every line. Fortran
+	drops the "E" from any float with a three-digit exponent, so those always
+	come out without it, and so does a random share eless of the rest.
+	"""
+	
+	fields = ["%15.7E" % value for value in values]
+	for i, value in enumerate(values):
+		if "E" in fields[i] and (value != 0.0 and abs(np.log10(value)) >= 99.0
+				or rng.uniform() < eless):
+			mantissa, exponent = ("%.7E" % value).split("E")
+			fields[i] = ("%s%+03d" % (mantissa, int(exponent))).rjust(15)
+	lines = ["".join(fields[i:i+per_line])
+		for i in range(0, len(fields), per_line)]
+	return "\n".join(lines) + "\n"
+
+def synthetic_model(filename, kk=1000, netsize=50, eless=0.0, new=False,
+		seed=0):
+	"""Write a synthetic Tycho model file with kk zones and a network of
+	netsize isotopes, filled with random values of realistic magnitudes. The
+	network starts with the neutron, then goes through the elements from
+	hydrogen to zinc adding one heavier isotope of each on every pass, and
+	ends with Ye. The mass fractions in each zone add up to one, and Ye is
+	worked out from them. A share eless of the floats get written without
+	their "E", and if new is True, the first line gets the "8.00new" prefix
+	of a fresh imodel.
+	"""
+	
+	rng = np.random.RandomState(seed)
+	nzones = kk + 2
+	
+	# Make up a network of isotopes, with Ye tacked on at the end
+	nz = np.zeros(netsize, dtype=int)
+	nn = np.ones(netsize, dtype=int)
+	nz[1:] = 1 + np.arange(netsize - 1) % (len(ELEMENTS) - 1)
+	nn[1:] = nz[1:] - (nz[1:] == 1) + np.arange(netsize - 1) \
+		// (len(ELEMENTS) - 1)
+	isotopes = [SPECIAL_NAMES.get((z, z + n), "%s%d" % (ELEMENTS[z], z + n))
+		for z, n in zip(nz, nn)]
+	isotopes.append("Ye")
+	
+	# Tiny abundances are where the three-digit exponents show up
+	fractions = rng.uniform(0.1, 1.0, (netsize, nzones)) \
+		* 10.0 ** rng.randint(-130, 0, (netsize, nzones))
+	fractions /= fractions.sum(axis=0)
+	ye = np.dot(nz / (nz + nn), fractions)
+	fractions = np.vstack([fractions, ye])
+	nz = np.append(nz, 0)
+	nn = np.append(nn, 0)
+	
+	prefix = "8.00new" if new else "8.00 Ea"
+	lines = ["TYCHO %s 1.000 %d 2.0000E-02" % (prefix, netsize)]
+	for name, value in [("time", "1.2340000E+15"), ("kk", str(kk)),
+			("netsize", str(netsize)), ("xm(kk)", "1.9890000E+33"),
+			("opacity tables used", "OPAL")]:
+		lines.append(" %-31s%s" % (name, value))
+	chunks = ["\n".join(lines) + "\n\n\n"]
+	
+	for name in PHYSICS:
+		values = rng.uniform(0.1, 1.0, nzones) \
+			* 10.0 ** rng.randint(-30, 30, nzones)
+		chunks.append(" %s\n" % name + format_floats(values, eless=eless,
+			rng=rng))
+	
+	half = (netsize + 2) // 2
+	for ints in [nz, nn]:
+		chunks.append("".join("%4d" % i for i in ints[:half]) + "\n")
+		chunks.append("".join("%4d" % i for i in ints[half:]) + "\n")
+	chunks.append("\n".join("".join("%5s" % name for name in isotopes[i:i+10])
+		for i in range(0, len(isotopes), 10)) + "\n")
+	chunks.append(format_floats(rng.uniform(0.1, 1.0, len(isotopes)),
+		eless=eless, rng=rng))
+	
+	for name, values in zip(isotopes, fractions):
+		chunks.append(" %s\n" % name + format_floats(values, eless=eless,
+			rng=rng))
+	chunks.append("\n\n")
+	
+	with open(filename, "w") as f:
+		f.write("".join(chunks))
+
+
+# BENCHMARKS
+############
+
+def best_time(function, repeat=3):
+	"""Return the best wall time out of several calls to a function."""
+	
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+def peak_memory(function):
+	"""Return the peak memory allocated while calling a function, in bytes.
+	This is measured separately from any timing, since tracing every
+	allocation slows everything down quite a bit.
+	"""
+	
+	tracemalloc.start()
+	try:
+		function()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def report(name, seconds, nbytes, narrays, peak):
+	"""Print one line of benchmark results."""
+	
+	print("%-22s %9.4f s %9.2f MB/s %11.1f arrays/s %9.2f MB peak" % (name,
+		seconds, nbytes / 1024**2 / seconds, narrays / seconds,
+		peak / 1024**2))
+
+def check_write(filename):
+	"""Make sure that writing out the given model file and reading it back
+	gives the same keys and arrays, both for the whole model and for ones
+	with only some of the keys, where a label can come right after the list
+	of isotopes.
+	"""
+	
+	copy = filename + ".copy"
+	options = [{}, {"exclude": ["initial composition"]},
+		{"fields": ["isotope", "he4", "p"]}]
+	try:
+		for option in options:
+			model = tycho.TychoModel(filename, **option)
+			model.write(copy)
+			written = tycho.TychoModel(copy)
+			same = list(written.keys()) == list(model.keys()) and all(
+				np.array_equal(written[key], model[key]) for key in model)
+			if not same:
+				msg = "TychoModel.write changed the model read with " \
+					+ repr(option)
+				raise AssertionError(msg)
+	finally:
+		if os.path.exists(copy):
+			os.remove(copy)
+
+def check_timeline(filename):
+	"""Make sure that extract_timeline picks out the same values as a full
+	read of the given model file, for the first, second to last and last
+	value of every physics block. The last of those comes right before the
+	nz and nn ints, which mustn't be taken as part of it.
+	"""
+	
+	model = tycho.TychoModel(filename)
+	samples = dict(("%s[%d]" % (label, index), (label, index))
+		for label in PHYSICS for index in [0, -2, -1])
+	timeline = tycho_series.extract_timeline([filename], samples)
+	for name, (label, index) in samples.items():
+		if timeline[name][0] != model[label][index]:
+			msg = "extract_timeline got " + repr(timeline[name][0]) \
+				+ " for " + name + " instead of " + repr(model[label][index])
+			raise AssertionError(msg)
+
+def bench_loaders(filename, repeat=3, legacy=True):
+	"""Benchmark each way of reading the given model file, printing the
+	throughput in MB/s and arrays/s along with the peak memory used. The
+	float conversion utilities are timed on every float token in the file.
+	"""
+	
+	nbytes = os.path.getsize(filename)
+	model = tycho.TychoModel(filename)
+	narrays = len(model)
+	
+	# Reading the whole model file
+	load = lambda: tycho.TychoModel(filename)
+	report("TychoModel", best_time(load, repeat), nbytes, narrays,
+		peak_memory(load))
+	load = lambda: tycho.TychoModel(filename, lazy=True)
+	report("TychoModel(lazy=True)", best_time(load, repeat), nbytes, narrays,
+		peak_memory(load))
+	layout = tycho.ModelLayout(filename)
+	load = lambda: tycho.TychoModel(filename, layout=layout)
+	report("TychoModel(layout=...)", best_time(load, repeat), nbytes, narrays,
+		peak_memory(load))
+	with ProcessPoolExecutor() as pool:
+		load = lambda: tycho.TychoModel(filename, workers=pool)
+		report("TychoModel(workers)", best_time(load, repeat), nbytes,
+			narrays, peak_memory(load))
+	
+	# Writing the model back out again
+	copy = filename + ".copy"
+	write = lambda: model.write(copy)
+	report("TychoModel.write", best_time(write, repeat), nbytes, narrays,
+		peak_memory(write))
+	os.remove(copy)
+	
+	# The float conversion utilities, token by token
+	with open(filename, "rb") as f:
+		contents = f.read()
+	blocks = [contents[start:stop] for kind, start, stop
+		in tycho.scan_blocks(contents) if kind == "FLOAT"]
+	tokens = [token.decode() for block in blocks for token in block.split()]
+	nfloat = sum(len(block) for block in blocks)
+	convert = lambda: [tycho.recover_float(token) for token in tokens]
+	report("recover_float", best_time(convert, repeat), nfloat, len(blocks),
+		peak_memory(convert))
+	convert = lambda: [tycho.convert(token) for token in tokens]
+	report("convert", best_time(convert, repeat), nfloat, len(blocks),
+		peak_memory(convert))
+	convert = lambda: [tycho.recover_floats(block) for block in blocks]
+	report("recover_floats", best_time(convert, repeat), nfloat, len(blocks),
+		peak_memory(convert))
+	
+	# The original reader, which is slow enough to only run once
+	if legacy:
+		load = lambda: TYCHO_Model(filename)
+		old = TYCHO_Model(filename)
+		narrays = len(old.physics) + len(old.nuclei) + len(old.composition)
+		report("TYCHO_Model", best_time(load, 1), nbytes, narrays,
+			peak_memory(load))
+	
+	# The same interface running on TychoModel instead
+	load = lambda: tycho_legacy.TYCHO_Model(filename)
+	report("TYCHO_Model (fast)", best_time(load, repeat), nbytes, narrays,
+		peak_memory(load))
+
+def bench_scan(sizes=SCAN_SIZES, netsize=50, repeat=3):
+	"""Time classifying the blocks of synthetic model files of increasing
+	size with both scan_blocks and the TYCHO_PATTERN regex, printing the time
+	per megabyte for each. Linear scaling shows up as a flat time per MB.
+	"""
+	
+	regex = re.compile(tycho.TYCHO_PATTERN.encode("ascii"), re.MULTILINE)
+	directory = tempfile.mkdtemp(prefix="tycho_bench")
+	try:
+		print("%8s %10s %14s %14s" % ("kk", "MB", "lines s/MB", "regex s/MB"))
+		for kk in sizes:
+			filename = os.path.join(directory, "model%d" % kk)
+			synthetic_model(filename, kk, netsize)
+			with open(filename, "rb") as f:
+				contents = f.read()
+			mb = len(contents) / 1024**2
+			lines = best_time(lambda: list(tycho.scan_blocks(contents)), repeat)
+			regex_time = best_time(lambda: list(regex.finditer(contents)),
+				repeat)
+			print("%8d %10.2f %14.4f %14.4f" % (kk, mb, lines / mb,
+				regex_time / mb))
+	finally:
+		shutil.rmtree(directory)
+
+
+# MAIN
+######
+
+def main(argv=None):
+	"""Run the benchmarks from the command line."""
+	
+	parser = argparse.ArgumentParser(description="Benchmark reading Tycho "
+		"model files, using a synthetic model unless a file is given.")
+	parser.add_argument("filename", nargs="?",
+		help="existing model file to read instead of a synthetic one")
+	parser.add_argument("--kk", type=int, default=1000,
+		help="number of zones in the synthetic model")
+	parser.add_argument("--netsize", type=int, default=50,
+		help="number of isotopes in the synthetic model")
+	parser.add_argument("--eless", type=float, default=0.1,
+		help="share of floats written without their E")
+	parser.add_argument("--new", action="store_true",
+		help="use the 8.00new first line of a fresh imodel")
+	parser.add_argument("--repeat", type=int, default=3,
+		help="number of timing runs to take the best of")
+	parser.add_argument("--no-legacy", dest="legacy", action="store_false",
+		help="skip the slow legacy TYCHO_Model reader")
+	parser.add_argument("--scan", action="store_true",
+		help="measure how block scanning scales with file size instead")
+	args = parser.parse_args(argv)
+	
+	if args.scan:
+		bench_scan(netsize=args.netsize, repeat=args.repeat)
+	elif args.filename is not None:
+		bench_loaders(args.filename, args.repeat, args.legacy)
+	else:
+		directory = tempfile.mkdtemp(prefix="tycho_bench")
+		try:
+			filename = os.path.join(directory, "synthetic")
+			synthetic_model(filename, args.kk, args.netsize, args.eless,
+				args.new)
+			check_write(filename)
+			check_timeline(filename)
+			bench_loaders(filename, args.repeat, args.legacy)
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,277 @@
+# tycho_catalog.py
+
+# A searchable catalog of every Tycho model file in a simulation run
+# Finding the one model closest to some time, or every model past some point in
+# its evolution, shouldn't mean reading thousands of model files every time
+# The catalog keeps header values and a few sampled data values in SQLite
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import os
+import fnmatch
+import sqlite3
+from collections import OrderedDict
+
+from tycho import TychoModel
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Data values to record for each model by default, as name: (key, index)
+# The first zone is the center of the star and the last one is the surface
+DEFAULT_SAMPLES = OrderedDict([
+	("core p", ("p", 0)),
+	("core he4", ("he4", 0)),
+	("core temperature", ("temperature", 0)),
+	("surface radius", ("radius", -1)),
+	("surface luminosity", ("luminosity", -1)),
+])
+
+# Comparison operators that can be used in catalog queries
+OPERATORS = ["<", "<=", ">", ">=", "=", "==", "!=", "<>"]
+
+# Table layout, where scalar names and values are left untyped so that SQLite
+# keeps the int keys from the first line and the mix of value types as they are
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+	path TEXT PRIMARY KEY,
+	size INTEGER,
+	mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS scalars (
+	path TEXT REFERENCES models (path) ON DELETE CASCADE,
+	name,
+	value,
+	PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS scalars_by_value ON scalars (name, value);
+"""
+
+
+# CATALOG CLASS
+###############
+
+class ModelCatalog(object):
+	"""A catalog of Tycho model files stored in an SQLite database. Every
+	model gets one row per scalar: each value from its first line (under the
+	same int keys as TychoModel.header), each value from its header, and each
+	of the sampled data values. Models are looked up by their absolute paths,
+	and only get read again if their size or modification time changes.
+	"""
+	
+	def __init__(self, database=":memory:", samples=None):
+		"""Open (or create) the catalog in the given SQLite database file.
+		The samples are a dict of name: (key, index) for the data values to
+		record from each model, like {"core p": ("p", 0)}, and default to
+		DEFAULT_SAMPLES. Changing the samples only affects models that get
+		read after the change.
+		"""
+		
+		self.database = database
+		self.samples = DEFAULT_SAMPLES if samples is None else samples
+		self.connection = sqlite3.connect(database)
+		self.connection.execute("PRAGMA foreign_keys = ON")
+		self.connection.executescript(SCHEMA)
+	
+	def __repr__(self):
+		return "ModelCatalog(" + repr(self.database) + ")"
+	
+	def __len__(self):
+		return self.connection.execute("SELECT count(*) FROM models") \
+			.fetchone()[0]
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.close()
+	
+	def close(self):
+		"""Close the connection to the database."""
+		
+		self.connection.close()
+	
+	def _read(self, path):
+		"""Return a list of (name, value) pairs for all of the scalars of the
+		given model file, or None if it isn't a whole Tycho model file after
+		all or can't be read at all.
+		"""
+		
+		# Only parse the arrays that actually get sampled
+		keys = set(key for key, index in self.samples.values())
+		try:
+			model = TychoModel(path, fields=keys)
+			complete = model.is_complete()
+		except (OSError, EOFError, SyntaxError, ValueError, UnicodeDecodeError):
+			return None
+		
+		# Files that are cut off (like ones still being written) would give
+		# the wrong surface values, so leave them for next time
+		if not complete:
+			return None
+		
+		return self._scalars(model)
+	
+	def _scalars(self, model):
+		"""Return a list of (name, value) pairs for all of the scalars of the
+		given TychoModel.
+		"""
+		
+		# Missing keys and zones just get recorded as NULL
+		scalars = list(model.header.items())
+		for name, (key, index) in self.samples.items():
+			try:
+				scalars.append((name, float(model[key][index])))
+			except (KeyError, IndexError):
+				scalars.append((name, None))
+		
+		return scalars
+	
+	def update(self, directory, pattern="*"):
+		"""Walk through the given directory and all of its subdirectories,
+		and catalog every Tycho model file with a name matching the pattern.
+		Only files that are new or have changed since they were last
+		cataloged get read, and files that have disappeared get dropped from
+		the catalog. Files that turn out not to be Tycho model files, or that
+		can't be read, are skipped. Return the number of model files that
+		were read.
+		"""
+		
+		# Look up what's already known about this directory
+		directory = os.path.abspath(directory)
+		prefix = os.path.join(directory, "")
+		known = dict((path, (size, mtime)) for path, size, mtime
+			in self.connection.execute("SELECT path, size, mtime FROM models "
+				+ "WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)))
+		
+		count = 0
+		with self.connection:
+			for root, dirs, files in os.walk(directory):
+				dirs.sort()
+				for name in sorted(fnmatch.filter(files, pattern)):
+					path = os.path.join(root, name)
+					if os.path.abspath(path) == os.path.abspath(self.database):
+						continue
+					
+					# Skip anything that hasn't changed since last time, or that
+					# was deleted in the meantime
+					try:
+						stat = os.stat(path)
+					except OSError:
+						continue
+					source = (stat.st_size, stat.st_mtime_ns)
+					if known.pop(path, None) == source:
+						continue
+					
+					# Replace whatever was there with a fresh set of scalars
+					if self._record(path, source, self._read(path)):
+						count += 1
+			
+			# Whatever didn't turn up this time is gone now
+			self.connection.executemany("DELETE FROM models WHERE path = ?",
+				[(path,) for path in known])
+		
+		return count
+	
+	def _record(self, path, source, scalars):
+		"""Replace any entry for the given path with a new one, given the
+		(size, mtime) of the file and its list of scalars, or just delete the
+		entry if scalars is None. Return whether anything got recorded.
+		"""
+		
+		self.connection.execute("DELETE FROM models WHERE path = ?", (path,))
+		if scalars is None:
+			return False
+		self.connection.execute("INSERT INTO models VALUES (?, ?, ?)",
+			(path,) + source)
+		self.connection.executemany("INSERT INTO scalars VALUES (?, ?, ?)",
+			[(path, scalar, value) for scalar, value in scalars])
+		return True
+	
+	def add(self, model):
+		"""Catalog a TychoModel that has already been read, so that its model
+		file doesn't have to be read again. The model needs to have all of
+		the keys used by the samples for them to get recorded.
+		"""
+		
+		path = os.path.abspath(model.filename)
+		stat = os.stat(path)
+		with self.connection:
+			self._record(path, (stat.st_size, stat.st_mtime_ns),
+				self._scalars(model))
+	
+	def _load(self, paths, load, options):
+		"""Return the given paths, or the models they lead to if load is True,
+		using any other options for reading the models.
+		"""
+		
+		if load:
+			return [TychoModel(path, **options) for path in paths]
+		return paths
+	
+	def paths(self):
+		"""Return a sorted list of the paths of every cataloged model."""
+		
+		return [path for path, in self.connection.execute("SELECT path FROM "
+			+ "models ORDER BY path")]
+	
+	def scalars(self, path):
+		"""Return an OrderedDict of all of the scalars cataloged for the given
+		model file, in the same order that they were recorded.
+		"""
+		
+		rows = self.connection.execute("SELECT name, value FROM scalars "
+			+ "WHERE path = ? ORDER BY rowid", (os.path.abspath(path),))
+		return OrderedDict(rows)
+	
+	def select(self, *conditions, **options):
+		"""Return the paths of all of the cataloged models that satisfy every
+		one of the given conditions, where each condition is a tuple of
+		(name, operator, value), like ("core p", "<", 0.01). The results are
+		ordered by the scalar named by order (default "time"), and then by
+		path. If load is True, then the models are returned as TychoModel
+		objects instead, and any other options are passed along to them.
+		"""
+		
+		load = options.pop("load", False)
+		order = options.pop("order", "time")
+		
+		# Each condition is a lookup in the scalars table
+		query = "SELECT models.path FROM models LEFT JOIN scalars AS ordering " \
+			+ "ON ordering.path = models.path AND ordering.name = ?"
+		arguments = [order]
+		clauses = []
+		for name, operator, value in conditions:
+			if operator not in OPERATORS:
+				msg = "unknown comparison operator: " + repr(operator)
+				raise ValueError(msg)
+			clauses.append("models.path IN (SELECT path FROM scalars WHERE "
+				+ "name = ? AND value " + operator + " ?)")
+			arguments.extend([name, value])
+		if clauses:
+			query += " WHERE " + " AND ".join(clauses)
+		query += " ORDER BY ordering.value, models.path"
+		
+		paths = [path for path, in self.connection.execute(query, arguments)]
+		return self._load(paths, load, options)
+	
+	def closest(self, name, value, **options):
+		"""Return the path of the cataloged model with the scalar of the given
+		name closest to the given value, like closest("time", 3.0e15), or
+		None if no model has that scalar. If load is True, then the model is
+		returned as a TychoModel object instead, and any other options are
+		passed along to it.
+		"""
+		
+		load = options.pop("load", False)
+		row = self.connection.execute("SELECT path FROM scalars WHERE "
+			+ "name = ? AND value IS NOT NULL ORDER BY abs(value - ?), path "
+			+ "LIMIT 1", (name, value)).fetchone()
+		if row is None:
+			return None
+		return self._load(row, load, options)[0]
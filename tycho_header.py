@@ -0,0 +1,214 @@
+# tycho_header.py
+
+# Reading just the first line and header of Tycho model files, without Numpy
+# Short scripts that only want a header value get run thousands of times from
+# shell loops, so nothing in here imports anything heavier than the standard
+# library, and tycho.py builds the rest of the model reading on top of it
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import re
+import bz2
+import gzip
+import lzma
+from collections import OrderedDict
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Regular expression patterns for the first line and the lines of the header
+STR_PAT = r"\S+(?: \S+)*"  # String with optional single spaces
+FIRST_PAT = r"^TYCHO( +\S+)+ *$"
+HEADER_PAT = r"^ *(" + STR_PAT + r") {2,}(" + STR_PAT + r") *$"
+
+# Magic bytes at the start of compressed files, and how to open each kind
+COMPRESSION_MAGIC = [
+	(b"\x1f\x8b", gzip.open),
+	(b"BZh", bz2.open),
+	(b"\xfd7zXZ\x00", lzma.open),
+]
+
+
+# UTILITY FUNCTIONS
+###################
+
+def recover_float(string):
+	"""Parse and return a floating point number from a string that Fortran may
+	or may not have mangled.
+	"""
+	
+	# Remove whitespace and try to parse the float the easy way
+	string = string.strip()
+	try:
+		value = float(string)
+	
+	# If that strategy fails, then check that the 'E' is missing and fix it
+	except ValueError:
+		match = re.match(r"^([-+]?[0-9]+\.[0-9]+)([-+][0-9]+)$", string)
+		if match:
+			value = float(match.group(1) + "E" + match.group(2))
+		else:
+			msg = "recover_float failed to parse string: " + repr(string)
+			raise ValueError(msg)
+	
+	return value
+
+def convert(string):
+	"""Convert the given string to an int or float if appropriate."""
+	
+	# Try converting to an int first, then to a float, then just give up
+	try:
+		value = int(string)
+	except ValueError:
+		try:
+			value = recover_float(string)  # Never trust floats from Fortran
+		except ValueError:
+			value = str(string)  # Eliminate any weird subclasses of str
+	
+	return value
+
+def open_stream(source):
+	"""Return a binary file object for reading the decompressed contents of
+	a model file, given either a filename or a file-like object, or None if
+	the source is a plain model file on disk that can be memory-mapped
+	instead. Files compressed with gzip, bzip2 or xz are recognized by the
+	magic bytes at the start, so their names don't matter. File-like objects
+	that can't be peeked at or rewound are assumed to be uncompressed.
+	"""
+	
+	# Look at the first few bytes without using them up
+	if hasattr(source, "read"):
+		if hasattr(source, "peek"):
+			head = source.peek(8)[:8]
+		elif hasattr(source, "seekable") and source.seekable():
+			position = source.tell()
+			head = source.read(8)
+			source.seek(position)
+		else:
+			head = b""
+	else:
+		with open(source, "rb") as openfile:
+			head = openfile.read(8)
+	
+	# Decompress if needed, and only map plain files on disk
+	if isinstance(head, bytes):
+		for magic, opener in COMPRESSION_MAGIC:
+			if head.startswith(magic):
+				return opener(source, "rb")
+	return source if hasattr(source, "read") else None
+
+def source_name(source):
+	"""Return the file name to use for a model file source, which is just the
+	source itself if it's a filename. File objects only go by their name if
+	they're reading a real file on disk, since members of a tar archive (for
+	example) have the name of the whole archive, so anything else gets None.
+	"""
+	
+	if not hasattr(source, "read"):
+		return source
+	
+	try:
+		source.fileno()
+	except (AttributeError, OSError, ValueError):
+		return None
+	
+	return getattr(source, "name", None)
+
+def close_stream(stream, source):
+	"""Close a stream returned by open_stream, unless it's the file object
+	that was passed in, which is up to the caller to close.
+	"""
+	
+	if stream is not None and stream is not source:
+		stream.close()
+
+def read_head(source):
+	"""Return the raw bytes at the start of the given file (or compressed
+	file, or file-like object), up to but not including the first blank line.
+	For a Tycho model file, this is the first line plus the header, and none
+	of the data that follows.
+	"""
+	
+	# Read one line at a time so nothing past the header gets read in
+	lines = []
+	stream = open_stream(source)
+	openfile = open(source, "rb") if stream is None else stream
+	try:
+		for line in openfile:
+			if not isinstance(line, bytes):
+				line = line.encode()
+			line = line.rstrip(b"\r\n")
+			if line.strip() == b"":
+				break
+			lines.append(line + b"\n")
+	finally:
+		close_stream(openfile, source)
+	
+	return b"".join(lines)
+
+
+# HEADER PARSING
+################
+
+def parse_first(string, header):
+	"""Parse the first line of a model file into the given header dict, where
+	each value is stored under its ordered index.
+	"""
+	
+	# Split the first line string into bit at any amount of whitespace
+	# WEIRD EDGE CASE: the third thing on this line is the simulation file
+	# prefix, which is usually just two characters. However, if the model
+	# file is an imodel that was just generated, the prefix will be the
+	# three-character string "new", which will abut the version number (the
+	# second thing on this line). In this situation, we need to add some
+	# whitespace in between before splitting the string. I originally tried
+	# to solve this by using a zero-length splitter in re.split, but that
+	# raises a FutureWarning in Python 3 apparently.
+	string = re.sub(r"([0-9]+\.[0-9]+)(new )", r"\1 \2", string.strip())
+	bits = re.split(r" +", string.strip())
+	
+	for i, bit in enumerate(bits):
+		
+		# Convert the bit to an int or a float if appropriate
+		# Store the bits in the header dict by their ordered index
+		header[i] = convert(bit)
+
+def parse_header(string, header):
+	"""Parse the header of a model file, not including the first line, into
+	the given header dict.
+	"""
+	
+	# Extract the variable name and value from each header line
+	matches = re.finditer(HEADER_PAT, string.strip(), flags=re.MULTILINE)
+	
+	for match in matches:
+		
+		name, value = match.group(1, 2)
+		
+		# Convert the value to an int or a float if appropriate
+		# Save value to the header dict using the variable name as the key
+		header[str(name)] = convert(value)
+
+def read_header(filename):
+	"""Read only the first line and header of a Tycho model file, and return
+	them as an OrderedDict just like TychoModel.header, without ever touching
+	the data in the rest of the file.
+	"""
+	
+	header = OrderedDict()
+	string = read_head(filename).decode()
+	
+	# The first line only counts if it really is one
+	first, _, rest = string.partition("\n")
+	if re.match(FIRST_PAT, first):
+		parse_first(first, header)
+	else:
+		rest = string
+	parse_header(rest, header)
+	
+	return header
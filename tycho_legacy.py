@@ -0,0 +1,67 @@
+# tycho_legacy.py
+
+# A drop-in replacement for the TYCHO_Model class from stars_2_code, built on
+# top of TychoModel so that old scripts get the fast parser for free
+# The attributes are all the same, but the dicts hold Numpy arrays (which are
+# just views of the arrays in the TychoModel underneath) instead of lists
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+from tycho import TychoModel, read_head, recover_float
+
+
+# LEGACY MODEL CLASS
+####################
+
+class TYCHO_Model(object):
+	"""Simple class for reading and exploring TYCHO model files, with the same
+	interface as the original in stars_2_code/tycho_model.py. The first line
+	values get their own attributes, self.header holds the rest of the header,
+	self.physics the data for each zone that comes before the nuclei,
+	self.nuclei the nz, nn, name and initial mass fraction of each isotope, and
+	self.composition the mass fractions of each isotope in each zone. The
+	TychoModel that all of the arrays come from is kept in self.model.
+	"""
+	
+	def __init__(self, filename, **options):
+		"""Read the model file of the given name. Any options are passed along
+		to TychoModel.
+		"""
+		
+		self.filename = filename
+		self.model = model = TychoModel(filename, **options)
+		
+		# The first line, and the basic bulk info that it starts with
+		self.first_line = read_head(filename).split(b"\n")[0].decode().strip()
+		self.prefix = model.header[2]
+		self.mass = float(model.header[3])
+		self.network_size = int(model.header[4])
+		self.metallicity = float(model.header[5])
+		
+		# The rest of the header
+		self.header = dict((key, value) for key, value in model.header.items()
+			if not isinstance(key, int))
+		
+		# Everything before the nuclei is physics, and everything after is
+		# composition, without copying any of the arrays
+		self.physics = {}
+		self.nuclei = {}
+		self.composition = {}
+		nuclei = {"nz": "nz", "nn": "nn", "isotope": "name",
+			"initial composition": "initial mass fraction"}
+		section = self.physics
+		for label, value in model.items():
+			if label in nuclei:
+				self.nuclei[nuclei[label]] = value
+				section = self.composition
+			else:
+				section[label] = value
+
+def whyyy_float(string):
+	"""Parse stupid floats with 'E' missing that Fortran has butchered."""
+	
+	return recover_float(string)
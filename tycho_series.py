@@ -0,0 +1,588 @@
+# tycho_series.py
+
+# Tools for working with whole sequences of Tycho model files all at once
+# A simulation run can leave behind thousands of model files, and reading them
+# one at a time with TychoModel leaves all but one core sitting idle
+# The loaders here spread the parsing out over a pool of worker processes
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import os
+import re
+import glob
+import queue
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+from tycho import TychoModel, ModelLayout, LINE_REGEX, RUN_REGEXES, \
+	derived_dependencies, recover_float, recover_floats, open_stream, \
+	map_file, unmap_file, read_header
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Byte alignment for arrays packed together into one block of shared memory
+ALIGNMENT = 64
+
+# The first value in a block of floats
+FIRST_VALUE = re.compile(rb" *(\S+)")
+
+# More than enough bytes at the end of a block to hold its last value
+LAST_VALUE_SIZE = 64
+
+
+# UTILITY FUNCTIONS
+###################
+
+def default_workers():
+	"""Return the number of CPUs that this process is allowed to use."""
+	
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return os.cpu_count() or 1
+
+def find_paths(paths):
+	"""Return a sorted list of model file paths, given either a list of paths
+	or a single glob pattern (like "Ea*") that matches them.
+	"""
+	
+	if isinstance(paths, str):
+		paths = glob.glob(paths)
+	
+	return sorted(paths)
+
+def select_fields(model, fields):
+	"""Return (label, array) pairs for the requested fields of a TychoModel,
+	in the same order as the model file, or all of them if fields is None.
+	"""
+	
+	# No selection at all means everything
+	if fields is None:
+		return list(model.items())
+	
+	# Make sure that everything asked for is actually there
+	for label in fields:
+		if label not in model:
+			msg = "field " + repr(label) + " is not in " + repr(model.filename)
+			raise KeyError(msg)
+	
+	return [(label, model[label]) for label in model if label in fields]
+
+def _create_shared_memory(size):
+	"""Create a new block of shared memory that the calling process is not
+	responsible for cleaning up. Whoever receives the block must unlink it.
+	"""
+	
+	# Python 3.13+ can just be told not to track the block
+	try:
+		return shared_memory.SharedMemory(create=True, size=size, track=False)
+	except TypeError:
+		pass
+	
+	# Otherwise, untrack it by hand, or else the resource tracker destroys the
+	# block as soon as the worker process exits
+	block = shared_memory.SharedMemory(create=True, size=size)
+	resource_tracker.unregister(block._name, "shared_memory")
+	return block
+
+def _load_worker(filename, fields, dtype, layout):
+	"""Parse one model file in a worker process and pack the requested arrays
+	into one block of shared memory, so that sending them back to the main
+	process doesn't involve pickling any of the data. Return everything the
+	main process needs to find the arrays again.
+	"""
+	
+	model = TychoModel(filename, fields=fields, dtype=dtype, layout=layout)
+	select_fields(model, fields)  # Only to check that they're all there
+	header, arrays, composition, rows = model._export()
+	
+	# The composition matrix goes first, under the label None, and then the
+	# rest of the arrays, except for those that are rows of the matrix
+	if composition is not None:
+		arrays = [(None, composition)] + arrays
+	
+	# Lay out the arrays one after another in the block
+	layout = []
+	size = 0
+	for label, value in arrays:
+		if value is None:
+			layout.append((label, None, None, None))
+			continue
+		value = np.ascontiguousarray(value)
+		layout.append((label, value.dtype.str, value.shape, size))
+		size += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+	
+	# Copy the arrays into shared memory
+	block = _create_shared_memory(max(size, 1))
+	try:
+		for (_, value), (_, dtype, shape, offset) in zip(arrays, layout):
+			if value is None:
+				continue
+			packed = np.ndarray(shape, dtype, buffer=block.buf, offset=offset)
+			packed[...] = value
+			del packed  # Release the buffer so that the block can be closed
+	finally:
+		block.close()
+	
+	return header, rows, layout, size, block.name
+
+def _unpack(filename, header, rows, layout, size, name):
+	"""Rebuild a TychoModel in the main process from the results of
+	_load_worker, and free up the shared memory. The arrays all end up as
+	views into one contiguous block of local memory.
+	"""
+	
+	# Copy the whole shared block in one go, then get rid of it
+	block = shared_memory.SharedMemory(name=name)
+	try:
+		local = np.empty(size, dtype=np.uint8)
+		local[...] = np.frombuffer(block.buf, dtype=np.uint8, count=size)
+	finally:
+		block.close()
+		block.unlink()
+	
+	# Cut the local copy back up into the individual arrays
+	composition = None
+	arrays = []
+	for label, dtype, shape, offset in layout:
+		value = None
+		if dtype is not None:
+			value = np.ndarray(shape, dtype, buffer=local, offset=offset)
+		if label is None:
+			composition = value
+		else:
+			arrays.append((label, value))
+	
+	return TychoModel.from_arrays(filename, header, arrays, composition, rows)
+
+def _discard(future):
+	"""Free the shared memory from a worker whose results will never be used."""
+	
+	if not future.cancel() and future.exception() is None:
+		block = shared_memory.SharedMemory(name=future.result()[-1])
+		block.close()
+		block.unlink()
+
+
+# PARALLEL LOADING
+##################
+
+def load_many(paths, workers=None, fields=None, dtype=np.float64,
+		layout=None, sparse=None):
+	"""Read many Tycho model files in parallel and return a list of TychoModel
+	objects sorted by filename. The paths can be a list of model files or a
+	glob pattern. The files are parsed on a pool of worker processes (by
+	default one per CPU), and the arrays come back through shared memory. If
+	fields is a list of keys, then only those arrays are kept. The dtype,
+	layout and sparse floor are passed along to TychoModel, except that if
+	layout is True, then the first model file is used as the template for all
+	of them. Workers always send back a dense composition matrix, which is
+	only made sparse once it gets to the main process.
+	"""
+	
+	paths = find_paths(paths)
+	if layout is True:
+		layout = ModelLayout(paths[0]) if paths else None
+	
+	# There's no point in starting up a pool for one worker
+	if workers is None:
+		workers = default_workers()
+	if workers <= 1 or len(paths) <= 1:
+		models = []
+		for path in paths:
+			model = TychoModel(path, fields=fields, dtype=dtype, layout=layout,
+				sparse=sparse)
+			select_fields(model, fields)  # Only to check that they're all there
+			models.append(model)
+		return models
+	
+	# Start parsing all of the files at once
+	models = []
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(_load_worker, path, fields, dtype, layout)
+			for path in paths]
+		
+		# Collect the results in order as they become available
+		try:
+			for path, future in zip(paths, futures):
+				model = _unpack(path, *future.result())
+				model._sparsify(sparse)
+				models.append(model)
+		
+		# Make sure that no shared memory gets left behind if anything fails
+		except:
+			for future in futures[len(models):]:
+				_discard(future)
+			raise
+	
+	return models
+
+
+# PREFETCHING
+#############
+
+def _prefetch(paths, fields, options, slots, results, stop):
+	"""Read each model file in turn on a background thread for iter_models,
+	taking one of the slots before starting on each, and put the models (or
+	whatever error came up reading one) into the results queue in order.
+	"""
+	
+	for path in paths:
+		slots.acquire()
+		if stop.is_set():
+			return
+		try:
+			model = TychoModel(path, fields=fields, **options)
+			select_fields(model, fields)  # Only to check that they're all there
+			results.put((model, None))
+		except Exception as error:
+			results.put((None, error))
+		model = None  # Don't hold on to it while waiting for the next slot
+
+def iter_models(paths, prefetch=2, fields=None, release=False, **options):
+	"""Yield a TychoModel for each model file in order, given either a list
+	of paths or a glob pattern, while a background thread reads ahead on the
+	next prefetch files at most, so that reading overlaps with whatever the
+	caller does with each model. No more than prefetch + 1 models are ever
+	held at once, counting the one the caller is working on. If release is
+	True, then each model gets cleared out (keeping only its header) as soon
+	as the caller asks for the next one, so that holding on to it by accident
+	doesn't keep its arrays in memory. Any other options, including fields,
+	are passed along to TychoModel, except that if layout is True, then the
+	first model file is used as the template for all of them. An error
+	reading a file is raised when its model would have been yielded.
+	"""
+	
+	paths = find_paths(paths)
+	if options.get("layout") is True:
+		options["layout"] = ModelLayout(paths[0]) if paths else None
+	
+	# The thread takes a slot for each model that it starts reading, and
+	# every slot is given back once the caller is done with that model
+	slots = threading.Semaphore(max(prefetch, 0) + 1)
+	results = queue.Queue()
+	stop = threading.Event()
+	thread = threading.Thread(target=_prefetch, args=(paths, fields, options,
+		slots, results, stop))
+	thread.daemon = True
+	thread.start()
+	
+	try:
+		for _ in paths:
+			
+			# Wait for the next model to be ready
+			model, error = results.get()
+			if error is not None:
+				raise error
+			
+			yield model
+			
+			# The caller has moved on, so free up this model's slot
+			if release:
+				model.clear()
+			model = None
+			slots.release()
+	
+	# Stop the thread early if the caller stopped early
+	finally:
+		stop.set()
+		slots.release()
+
+
+# REGRIDDING
+############
+
+def needed_fields(names):
+	"""Return the set of keys that have to be read from model files in order
+	to get the given keys or derived quantities, or None if that's all of them
+	(because something depends on the whole composition). Derived quantities
+	stay in the set too, in case a model file has them after all.
+	"""
+	
+	needed = set(names)
+	for name in names:
+		needed.update(derived_dependencies(name))
+	
+	return None if "composition" in needed else needed
+
+def interpolate_rows(x, values, grid):
+	"""Linearly interpolate every row of the 2D array values, given at the
+	increasing coordinates x, onto the coordinates in grid, all in one go.
+	Grid points outside the range of x get NaN.
+	"""
+	
+	# Find the interval and weight for each grid point once, for every row
+	# Where x repeats a value, the last of the repeats is the one that counts
+	right = np.clip(np.searchsorted(x, grid, side="right"), 1, len(x) - 1)
+	left = right - 1
+	span = x[right] - x[left]
+	weight = np.divide(grid - x[left], span, out=np.ones_like(grid),
+		where=span != 0)
+	result = values[:, left] * (1.0 - weight) + values[:, right] * weight
+	result[:, (grid < x[0]) | (grid > x[-1])] = np.nan
+	
+	return result
+
+def cube_path(directory, field):
+	"""Return the path of the .npy file for one field of a cube on disk."""
+	
+	return os.path.join(directory, re.sub(r"[^A-Za-z0-9.+-]+", "_", field)
+		+ ".npy")
+
+def regrid(models, fields, grid, coordinate="enclosed mass", normalize=False,
+		out=None, dtype=np.float64):
+	"""Interpolate the given fields (keys or derived quantities) of a
+	sequence of models onto a shared grid of some coordinate, such as
+	"enclosed mass" or "radius", and return an OrderedDict of one 2D Numpy
+	array per field, with one row per model and one column per grid point.
+	The models can be TychoModel objects or the paths to model files (or a
+	glob pattern), which get read one at a time with only the keys needed.
+	If normalize is True, then the coordinate of each model is divided by
+	its value at the surface first, so that the grid runs from 0 to 1. If out
+	is the name of a directory, then the arrays are memory-mapped .npy files
+	in it (one per field) so that the whole cube never has to fit in memory.
+	"""
+	
+	if isinstance(models, str):
+		models = find_paths(models)
+	models = list(models)
+	fields = list(fields)
+	grid = np.asarray(grid, dtype=np.float64)
+	
+	# Set up the empty cube, in memory or on disk
+	shape = (len(models), len(grid))
+	cube = OrderedDict()
+	if out is not None and not os.path.isdir(out):
+		os.makedirs(out)
+	for field in fields:
+		if out is None:
+			cube[field] = np.empty(shape, dtype=dtype)
+		else:
+			cube[field] = np.lib.format.open_memmap(cube_path(out, field),
+				mode="w+", dtype=dtype, shape=shape)
+	
+	# Fill it in one model at a time, doing every field at once
+	keys = needed_fields(fields + [coordinate])
+	for i, model in enumerate(models):
+		if not isinstance(model, TychoModel):
+			model = TychoModel(model, fields=keys)
+		x = np.asarray(model.derived(coordinate), dtype=np.float64)
+		if normalize:
+			x = x / x[-1]
+		values = np.array([model.derived(field) for field in fields],
+			dtype=np.float64)
+		for field, row in zip(fields, interpolate_rows(x, values, grid)):
+			cube[field][i] = row
+	
+	# Make sure that everything has made it to disk
+	for array in cube.values():
+		if isinstance(array, np.memmap):
+			array.flush()
+	
+	return cube
+
+
+# TIMELINES
+###########
+
+def find_labels(contents, labels):
+	"""Return a dict of where the block of floats after each of the given
+	labels starts in the contents of a model file, for as many of them as can
+	be found. Only the label lines themselves are searched for, without
+	classifying anything else. An isotope name on a line of its own at the
+	end of the list of isotopes looks just like a label, so lines right after
+	a line of isotopes don't count.
+	"""
+	
+	pattern = rb"^ *(" + b"|".join(re.escape(label.encode())
+		for label in labels) + rb") *\r?\n"
+	starts = {}
+	for match in re.finditer(pattern, contents, re.MULTILINE):
+		label = match.group(1).decode()
+		if label in starts:
+			continue
+		
+		# There has to be a line of floats after it
+		start = match.end()
+		eol = contents.find(b"\n", start)
+		eol = len(contents) if eol < 0 else eol
+		if not LINE_REGEX["FLOAT"].fullmatch(contents, start, eol):
+			continue
+		
+		# And no line of isotopes before it
+		before = match.start() - 1
+		if before > 0:
+			bol = contents.rfind(b"\n", 0, before) + 1
+			if LINE_REGEX["ISOTOPE"].fullmatch(contents, bol, before):
+				continue
+		
+		starts[label] = start
+		if len(starts) == len(labels):
+			break
+	
+	return starts
+
+def sample_block(contents, start, index):
+	"""Return one value from the block of floats that starts at the given
+	position in the contents of a model file. The first and last values are
+	found without reading the rest of the block, but any other index means
+	converting the whole block.
+	"""
+	
+	if index == 0:
+		return recover_float(FIRST_VALUE.match(contents, start).group(1)
+			.decode())
+	
+	# Find where the block ends, which is after the last line of floats
+	# The nz and nn ints come right after the last block of physics, so this
+	# can't just look for a line that starts with a number
+	stop = start
+	while True:
+		match = RUN_REGEXES["FLOAT"].match(contents, stop)
+		if match is None or match.end() == stop:
+			break
+		stop = match.end()
+	if index == -1:
+		tail = contents[max(start, stop - LAST_VALUE_SIZE):stop]
+		return recover_float(tail.split()[-1].decode())
+	
+	return recover_floats(contents[start:stop])[index]
+
+def _timeline_row(path, samples):
+	"""Return the time and the sampled values from one model file, with NaN
+	for anything that isn't there. Plain model files get searched for just the
+	labels that are needed, and anything that can't be found that way (like
+	in compressed files, or unlabeled arrays) gets read the usual way.
+	"""
+	
+	header = read_header(path)
+	values = dict((name, np.nan) for name in samples)
+	
+	# Pick out the values straight from the file contents if possible
+	missing = OrderedDict(samples)
+	stream = open_stream(path)
+	if stream is None:
+		contents = map_file(path)
+		try:
+			labels = set(key for key, index in samples.values())
+			starts = find_labels(contents, labels)
+			for name, (key, index) in samples.items():
+				if key in starts:
+					try:
+						values[name] = sample_block(contents, starts[key], index)
+						del missing[name]
+					except IndexError:
+						pass
+		finally:
+			unmap_file(contents)
+	else:
+		stream.close()
+	
+	# Read whatever's left over the long way
+	if missing:
+		model = TychoModel(path, fields=set(key for key, index
+			in missing.values()))
+		for name, (key, index) in missing.items():
+			try:
+				values[name] = model[key][index]
+			except (KeyError, IndexError):
+				pass
+	
+	time = header.get("time", np.nan)
+	return [time] + [values[name] for name in samples]
+
+def extract_timeline(paths, samples, workers=1):
+	"""Pick a few values out of every model file in a run, and return them as
+	a Numpy structured array with one record per model, sorted by the time in
+	each header. The paths can be a list of model files or a glob pattern, and
+	samples is a dict of name: (key, index), like {"core_H": ("p", 0),
+	"L": ("luminosity", -1)}. Each record has the filename, the time and each
+	sample, with NaN for any that are missing. Only the first or last value of
+	each block gets read, without parsing the rest of the file. Files are
+	read on a pool of worker processes if workers is more than one, or None
+	for one per CPU.
+	"""
+	
+	paths = find_paths(paths)
+	samples = OrderedDict(samples)
+	
+	# Small results, so there's no need for shared memory here
+	if workers is None:
+		workers = default_workers()
+	if workers <= 1 or len(paths) <= 1:
+		rows = [_timeline_row(path, samples) for path in paths]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			rows = list(executor.map(_timeline_row, paths,
+				[samples] * len(paths)))
+	
+	# Pack everything into records and put them in time order
+	width = max([len(path) for path in paths] + [1])
+	dtype = [("filename", "U" + str(width)), ("time", np.float64)] \
+		+ [(str(name), np.float64) for name in samples]
+	timeline = np.array([tuple([path] + row) for path, row
+		in zip(paths, rows)], dtype=dtype)
+	
+	return timeline[np.argsort(timeline["time"], kind="stable")]
+
+
+# MODEL SERIES CLASS
+####################
+
+class TychoModelSeries(list):
+	"""A list of TychoModel objects for a sequence of model files from the same
+	simulation, sorted by filename so that they end up in time order. The
+	files are loaded in parallel using load_many.
+	"""
+	
+	def __init__(self, paths=(), workers=None, fields=None, dtype=np.float64,
+			layout=None, sparse=None):
+		"""Load all of the model files given as a list of paths or as a glob
+		pattern. See load_many for the other arguments.
+		"""
+		
+		super(TychoModelSeries, self).__init__(load_many(paths, workers,
+			fields, dtype, layout, sparse))
+	
+	def __repr__(self):
+		return "TychoModelSeries(" + repr(self.filenames) + ")"
+	
+	def _repr_pretty_(self, p, cycle):
+		"""IPython "pretty printer" override method to enforce __repr__."""
+		
+		p.text(repr(self))
+	
+	@property
+	def filenames(self):
+		"""List of the model filenames, in order."""
+		
+		return [model.filename for model in self]
+	
+	def header_values(self, name):
+		"""Return a Numpy array of one header value from every model."""
+		
+		return np.array([model.header[name] for model in self])
+	
+	def derived(self, name):
+		"""Return a list of the arrays for one derived quantity (or key) from
+		every model, which each model remembers for next time.
+		"""
+		
+		return [model.derived(name) for model in self]
+	
+	def regrid(self, fields, grid, coordinate="enclosed mass",
+			normalize=False, out=None, dtype=np.float64):
+		"""Interpolate fields from every model onto a shared grid, as in the
+		regrid function.
+		"""
+		
+		return regrid(self, fields, grid, coordinate, normalize, out, dtype)
@@ -0,0 +1,235 @@
+# tycho_watch.py
+
+# Following a running Tycho simulation as it writes out new model files
+# Instead of rerunning a whole analysis to pick up the latest models, a watcher
+# keeps an eye on the output directory and only reads the files that are new
+# Files that Tycho is still in the middle of writing get left for later
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import os
+import time
+import fnmatch
+
+from tycho import TychoModel
+from tycho_series import TychoModelSeries
+
+# Use inotify to hear about new files right away if it's available, or else
+# fall back on checking the directory every so often
+try:
+	import inotify_simple
+except ImportError:
+	inotify_simple = None
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Seconds to wait between looks at the directory
+POLL_INTERVAL = 2.0
+
+# Seconds that a file has to go without changing before it gets read
+SETTLE_TIME = 1.0
+
+# Number of times to try reading a finished-looking file before giving up
+MAX_ATTEMPTS = 5
+
+# Errors that mean a model file couldn't be read, or isn't all there yet
+READ_ERRORS = (IOError, OSError, EOFError, SyntaxError, ValueError,
+	UnicodeDecodeError)
+
+
+# WATCHER CLASS
+###############
+
+class ModelWatcher(object):
+	"""Watches a directory that a running Tycho simulation is writing model
+	files into, and reads each new model file once it's done being written.
+	Every model that gets read is added to a series, which is a
+	TychoModelSeries in memory by default, but can also be anything with an
+	add method (like a ModelCatalog, to keep them on disk instead) or an
+	append method. A file counts as done once it has gone SETTLE_TIME
+	seconds without changing, reads without any errors, and is still the
+	same afterward, and it has to pass TychoModel.is_complete, which checks
+	that every isotope on the list turned up and that a plain file ends with
+	the blank line that Tycho finishes every model file with.
+	Files that fail are tried again later, until they've failed MAX_ATTEMPTS
+	times in a row without changing.
+	"""
+	
+	def __init__(self, directory, pattern="*", series=None, existing=True,
+			interval=POLL_INTERVAL, settle=SETTLE_TIME, **options):
+		"""Start watching the given directory for model files with names
+		matching the pattern. If existing is False, then any files already
+		there are ignored, and only new ones get read. The interval is how
+		many seconds to wait between looks at the directory, and settle is
+		how long a file has to sit still before it's read. Any other options
+		are passed along to TychoModel.
+		"""
+		
+		self.directory = directory
+		self.pattern = pattern
+		self.series = TychoModelSeries() if series is None else series
+		self.interval = interval
+		self.settle = settle
+		self.options = options
+		
+		# Files that have been read, as path: (size, mtime), files that have
+		# failed, as path: ((size, mtime), attempts), files that have been
+		# given up on, and files that are still waiting to be read
+		self.done = {}
+		self.failures = {}
+		self.failed = set()
+		self.pending = []
+		
+		# Mark the files that are already there as done if they don't count
+		if not existing:
+			for path, source in self._candidates():
+				self.done[path] = source
+		
+		# Set up inotify to wake up whenever a file gets written or moved in
+		self._inotify = None
+		if inotify_simple is not None:
+			flags = inotify_simple.flags
+			self._inotify = inotify_simple.INotify()
+			self._inotify.add_watch(directory, flags.CLOSE_WRITE
+				| flags.MOVED_TO)
+	
+	def __repr__(self):
+		return "ModelWatcher(" + repr(self.directory) + ")"
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.close()
+	
+	def close(self):
+		"""Stop listening for inotify events, if they were being used."""
+		
+		if self._inotify is not None:
+			self._inotify.close()
+			self._inotify = None
+	
+	def _candidates(self):
+		"""Yield (path, (size, mtime)) for every file in the directory with a
+		name matching the pattern, sorted by name.
+		"""
+		
+		names = sorted(fnmatch.filter(os.listdir(self.directory),
+			self.pattern))
+		for name in names:
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue  # Deleted in the meantime
+			if os.path.isfile(path):
+				yield path, (stat.st_size, stat.st_mtime_ns)
+	
+	def _read(self, path, source):
+		"""Try to read one model file that looks finished, and return the
+		TychoModel if it worked, or None if it should be tried again later.
+		"""
+		
+		# Never read a file with nothing in it or that changed too recently
+		age = time.time() - source[1] / 1e9
+		if source[0] == 0 or age < self.settle:
+			return None
+		
+		# A file that keeps failing without changing is just broken
+		last, attempts = self.failures.get(path, (None, 0))
+		if last != source:
+			attempts = 0
+		
+		# Read the file, and make sure that it didn't change while being read
+		# Compressed files that got cut off fail to decompress, but plain ones
+		# have to be checked for whether they really end where a model does
+		try:
+			model = TychoModel(path, **self.options)
+			stat = os.stat(path)
+			if (stat.st_size, stat.st_mtime_ns) != source:
+				return None
+			if not model.is_complete():
+				raise EOFError("model file " + repr(path) + " is cut off")
+		except READ_ERRORS:
+			self.failures[path] = (source, attempts + 1)
+			if attempts + 1 >= MAX_ATTEMPTS:
+				self.failed.add(path)
+			return None
+		
+		self.failures.pop(path, None)
+		return model
+	
+	def _add(self, model):
+		"""Add a freshly read model to the series."""
+		
+		if hasattr(self.series, "add"):
+			self.series.add(model)
+		else:
+			self.series.append(model)
+	
+	def poll(self):
+		"""Look at the directory once, read every model file that's new or
+		has changed and is done being written, add them to the series in
+		order of filename, and return a list of them.
+		"""
+		
+		models = []
+		self.pending = []
+		for path, source in self._candidates():
+			if self.done.get(path) == source:
+				continue
+			if path in self.failed:
+				if self.failures[path][0] == source:
+					continue
+				self.failed.discard(path)  # Changed, so give it another go
+			model = self._read(path, source)
+			if model is None:
+				self.pending.append(path)
+			else:
+				self.done[path] = source
+				self._add(model)
+				models.append(model)
+		
+		return models
+	
+	def wait(self, timeout=None):
+		"""Wait until something might have changed in the directory, which is
+		either when inotify says so or after the polling interval. Never waits
+		longer than timeout seconds, if one is given.
+		"""
+		
+		timeout = self.interval if timeout is None \
+			else min(timeout, self.interval)
+		if self._inotify is not None:
+			self._inotify.read(timeout=int(timeout * 1000))
+		else:
+			time.sleep(timeout)
+	
+	def follow(self, timeout=None):
+		"""Yield each new model as it gets read, in order, for as long as the
+		simulation keeps writing them, or forever if timeout is None. Otherwise,
+		stop once timeout seconds go by without any new models.
+		"""
+		
+		last = time.time()
+		while True:
+			for model in self.poll():
+				last = time.time()
+				yield model
+			
+			# Files that are waiting to settle won't set off inotify again, so
+			# come back to them once they should be done
+			wait = self.settle if self.pending else None
+			if timeout is not None:
+				remaining = last + timeout - time.time()
+				if remaining <= 0:
+					return
+				wait = remaining if wait is None else min(wait, remaining)
+			self.wait(wait)
+
@@ -0,0 +1,123 @@
+# tychopy.py
+
+# Command-line tool for quick looks at Tycho model files, replacing the old
+# gettime.py, getmass.py and magic_script.py scripts from stars_2_code
+# These get run thousands of times from shell loops, so commands that only need
+# the header never import Numpy (or tycho.py, which needs it) at all
+
+# Greg Vance
+
+
+# IMPORT STATEMENTS
+###################
+
+import sys
+import argparse
+
+from tycho_header import read_header
+
+
+# GLOBAL CONSTANTS
+##################
+
+# Grams in one Msun, erg/s in one Lsun, and seconds in one Myr
+MSUN = 1.98855e33
+LSUN = 3.826e33
+MYR = 31557600 * 1e6
+
+# Keys that the summary command needs from each model file
+SUMMARY_FIELDS = ["luminosity", "p", "he4", "d"]
+
+
+# SUBCOMMANDS
+#############
+
+def cmd_time(filename, args):
+	"""Print the time in seconds from the header of a model file."""
+	
+	print(filename + ":", read_header(filename)["time"])
+
+def cmd_header(filename, args):
+	"""Print the whole header of a model file, or just the keys asked for."""
+	
+	header = read_header(filename)
+	if len(args.filenames) > 1:
+		print(filename)
+	
+	# Values from the first line are stored by their index, so look up any
+	# key made of digits as an int
+	if args.key is None:
+		keys = header.keys()
+	else:
+		keys = [int(key) if key.isdigit() else key for key in args.key]
+	for key in keys:
+		print("  %-30s %s" % (key, header[key]))
+
+def cmd_mass(filename, args):
+	"""Print the total mass of a model file in Msun."""
+	
+	from tycho import TychoModel
+	model = TychoModel(filename, fields=["zone mass"])
+	print(filename, "\t", model["zone mass"].sum() / MSUN, "Msun")
+
+def cmd_summary(filename, args):
+	"""Print the age, luminosity and core abundances of a model file."""
+	
+	from tycho import TychoModel
+	model = TychoModel(filename, fields=SUMMARY_FIELDS)
+	lines = [
+		filename,
+		"  age (Myr)  " + str(model.header["time"] / MYR),
+		"  L / Lsun   " + str(model["luminosity"][-1] / LSUN),
+		"  core H     " + str(model["p"][0]),
+		"  core He    " + str(model["he4"][0]),
+		"  core D     " + str(model["d"][0]),
+	]
+	print("\n".join(lines))
+
+
+# MAIN
+######
+
+def main(argv=None):
+	"""Run the tychopy command-line tool and return its exit status."""
+	
+	parser = argparse.ArgumentParser(prog="tychopy",
+		description="Quick looks at Tycho model files.")
+	subparsers = parser.add_subparsers(dest="command", metavar="command")
+	subparsers.required = True
+	
+	# Every subcommand takes any number of model files
+	def add_command(name, function, help):
+		subparser = subparsers.add_parser(name, help=help, description=help)
+		subparser.add_argument("filenames", nargs="+", metavar="filename",
+			help="Tycho model file, which can be compressed")
+		subparser.set_defaults(function=function)
+		return subparser
+	
+	add_command("time", cmd_time, "print the time in seconds from the header")
+	header = add_command("header", cmd_header, "print header values")
+	header.add_argument("-k", "--key", action="append",
+		help="header key to print (can be given more than once, default all)")
+	add_command("mass", cmd_mass, "print the total mass in Msun")
+	add_command("summary", cmd_summary,
+		"print the age, luminosity and core H, He and D abundances")
+	args = parser.parse_args(argv)
+	
+	# Keep going past any file that can't be read, but remember the failure
+	status = 0
+	for filename in args.filenames:
+		try:
+			args.function(filename, args)
+		except KeyError as error:
+			print("tychopy: no key %r in %s" % (error.args[0], filename),
+				file=sys.stderr)
+			status = 1
+		except (IOError, OSError, ValueError, SyntaxError) as error:
+			print("tychopy: " + filename + ": " + str(error), file=sys.stderr)
+			status = 1
+	
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main())